@@ -3,23 +3,30 @@ This module implements conversation summarization
 for optimizing token usage with the Gemini API.
 """
 
-from datetime import datetime, timedelta
-import json
+from datetime import datetime
+import time
+
+# Rough token estimate used for the summary budget: about 4 characters per token
+CHARS_PER_TOKEN = 4
 
 class ContextCache:
     """
     Manages conversation summaries to reduce token usage in Gemini API requests.
     Note: Direct API caching was planned but is not supported in the current Gemini API version.
     This class now focuses on conversation summarization only.
+
+    The summary is rolling: the last recent_messages messages are always sent verbatim,
+    older ones are merged into the summary once they exceed max_unsummarized_tokens.
     """
     def __init__(self, context_manager, config=None):
         self.context_manager = context_manager
         
         # Set default config values
         self.enabled = True
-        self.summarization_enabled = True
-        self.messages_between_updates = 20
         self.hours_between_updates = 1
+        self.recent_messages = 10
+        self.max_unsummarized_tokens = 1000
+        self.max_summary_tokens = 300
         
         # Override with config if provided
         if config:
@@ -27,88 +34,134 @@ class ContextCache:
             summarization = context_settings.get("summarization", {})
             
             self.enabled = summarization.get("enabled", True)
-            self.summarization_enabled = self.enabled  # Both are the same now
-            self.messages_between_updates = summarization.get("messages_between_updates", 20)
             self.hours_between_updates = summarization.get("hours_between_updates", 1)
+            self.recent_messages = summarization.get("recent_messages", 10)
+            self.max_unsummarized_tokens = summarization.get("max_unsummarized_tokens", 1000)
+            self.max_summary_tokens = summarization.get("max_summary_tokens", 300)
+        
+        # chat_id -> position (see ContextManager.get_total_message_count) up to which
+        # messages are merged into the summary. Positions restart with the process, so this is not persisted
+        self._summarized_up_to = {}
+        # Chats already looked up and found without a summary, so the prompt path skips the store.
+        # Filled lazily instead of at startup to keep dormant chats out of memory
+        self._without_summary = set()
+    
+    def _unsummarized_messages(self, chat_id_str):
+        """Messages in history that are not covered by the summary yet"""
+        return self.context_manager.get_messages_since(chat_id_str, self._summarized_up_to.get(chat_id_str, 0))
+    
+    @staticmethod
+    def estimate_tokens(text):
+        """Cheap token estimate, good enough for budgeting"""
+        return len(text) // CHARS_PER_TOKEN
     
     def should_create_summary(self, chat_id):
         """Determines if a conversation summary should be created/updated"""
-        if not self.summarization_enabled:
+        if not self.enabled:
             return False
             
         chat_id_str = str(chat_id)
+        pending = self._unsummarized_messages(chat_id_str)
+        older = pending[:-self.recent_messages] if self.recent_messages else pending
+        # Nothing would be merged - the recent messages are sent verbatim anyway
+        if not older:
+            return False
         
-        # If no summary exists, create one
-        if chat_id_str not in self.context_manager.memory or "conversation_summary" not in self.context_manager.memory[chat_id_str]:
+        # Merge once the messages outside the verbatim tail no longer fit the budget
+        older_tokens = sum(self.estimate_tokens(msg.content) for msg in older)
+        if older_tokens > self.max_unsummarized_tokens:
             return True
         
-        # Check if summary is old
-        if "summary_timestamp" in self.context_manager.memory[chat_id_str]:
-            timestamp = datetime.fromisoformat(self.context_manager.memory[chat_id_str]["summary_timestamp"])
-            age = datetime.now() - timestamp
-            
-            # Update summary based on configured thresholds
-            message_count = len(self.context_manager.conversations.get(chat_id_str, []))
-            last_summarized_count = self.context_manager.memory[chat_id_str].get("summary_message_count", 0)
-            
-            if (message_count - last_summarized_count >= self.messages_between_updates or 
-                age > timedelta(hours=self.hours_between_updates)):
-                # Store current message count
-                self.context_manager.memory[chat_id_str]["summary_message_count"] = message_count
-                self.context_manager._save_memory()
+        # Refresh an old summary even if the budget is not used up yet
+        chat_memory = self.context_manager.memory.get(chat_id_str)
+        summary_timestamp = chat_memory.get("summary_timestamp") if chat_memory else None
+        if summary_timestamp is not None:
+            summary_ts = chat_memory.get("summary_ts")
+            if summary_ts is None:
+                # Summaries saved before summary_ts existed only have the ISO string
+                summary_ts = datetime.fromisoformat(summary_timestamp).timestamp()
+            if time.time() - summary_ts > self.hours_between_updates * 3600:
                 return True
         
         return False
     
-    def save_conversation_summary(self, chat_id, summary):
-        """Saves a generated conversation summary to memory"""
+    def get_summary_input(self, chat_id):
+        """
+        Get the data for the next summary update: (current summary or None,
+        formatted messages to merge into it, position the new summary will cover up to).
+        Returns None if there is nothing to merge
+        """
         chat_id_str = str(chat_id)
+        pending = self._unsummarized_messages(chat_id_str)
+        older = pending[:-self.recent_messages] if self.recent_messages else pending
+        if not older:
+            return None
+        covers_up_to = self.context_manager.get_total_message_count(chat_id_str) - (len(pending) - len(older))
+        return (
+            self.get_conversation_summary(chat_id_str),
+            self.context_manager.format_messages(older),
+            covers_up_to
+        )
+    
+    def get_context_for_prompt(self, chat_id):
+        """
+        Get (summary, recent messages) for the response prompt.
+        Without a summary the whole history is returned as recent messages
+        """
+        chat_id_str = str(chat_id)
+        summary = self.get_conversation_summary(chat_id_str)
+        if not summary:
+            return None, self.context_manager.get_conversation_context(chat_id_str)
+        # Everything the summary does not cover yet, but at least the verbatim tail
+        total = self.context_manager.get_total_message_count(chat_id_str)
+        start = min(self._summarized_up_to.get(chat_id_str, 0), total - self.recent_messages)
+        recent = self.context_manager.get_messages_since(chat_id_str, start)
+        return summary, self.context_manager.format_messages(recent)
+    
+    def save_conversation_summary(self, chat_id, summary, covers_up_to=None):
+        """
+        Saves a generated conversation summary to memory.
+        covers_up_to is the message position the summary includes, from get_summary_input
+        """
+        chat_id_str = str(chat_id)
+        chat_memory = self.context_manager.memory.setdefault(chat_id_str, {})
         
-        if chat_id_str not in self.context_manager.memory:
-            self.context_manager.memory[chat_id_str] = {}
-        
-        self.context_manager.memory[chat_id_str]["conversation_summary"] = summary
-        self.context_manager.memory[chat_id_str]["summary_timestamp"] = datetime.now().isoformat()
-        self.context_manager.memory[chat_id_str]["summary_message_count"] = len(self.context_manager.conversations.get(chat_id_str, []))
+        now = datetime.now()
+        chat_memory["conversation_summary"] = summary
+        # ISO string for humans, epoch seconds for the age check in should_create_summary
+        chat_memory["summary_timestamp"] = now.isoformat()
+        chat_memory["summary_ts"] = now.timestamp()
+        if covers_up_to is None:
+            covers_up_to = self.context_manager.get_total_message_count(chat_id_str)
+        self._summarized_up_to[chat_id_str] = covers_up_to
+        self._without_summary.discard(chat_id_str)
         
         # Save memory
-        self.context_manager._save_memory()
+        self.context_manager._save_memory(chat_id_str)
     
     def get_conversation_summary(self, chat_id):
         """Gets the saved conversation summary for a chat"""
         chat_id_str = str(chat_id)
-        
-        if chat_id_str in self.context_manager.memory and "conversation_summary" in self.context_manager.memory[chat_id_str]:
-            return self.context_manager.memory[chat_id_str]["conversation_summary"]
-        
-        return None
+        if chat_id_str in self._without_summary:
+            return None
+        chat_memory = self.context_manager.memory.get(chat_id_str)
+        summary = chat_memory.get("conversation_summary") if chat_memory is not None else None
+        if summary is None:
+            self._without_summary.add(chat_id_str)
+        return summary
     
     def get_chats_needing_summary(self):
         """Return a list of chat_ids that might need a summary update."""
+        if not self.enabled:
+            return []
         needs_summary = []
-        # Iterate through chats known by the context manager
-        # Note: We might need a better way to get all chat_ids if they aren't all in memory keys
+        # Only chats with history since startup can have anything new to summarize.
+        # Walking memory keys as well would fetch every dormant chat from the store
         all_chat_ids = list(self.context_manager.conversations.keys())
-        # Also check chat_ids from memory in case conversation history was cleared but memory remains
-        all_chat_ids.extend(list(self.context_manager.memory.keys()))
         
-        for chat_id in set(all_chat_ids): # Use set to avoid duplicates
+        for chat_id in all_chat_ids:
             if self.should_create_summary(chat_id):
                 needs_summary.append(chat_id)
                 
         return needs_summary
-    
-    # For compatibility with existing code
-    def get_cache_key(self, chat_id):
-        """
-        Stub method for compatibility - the current Gemini API doesn't support cache keys.
-        Always returns None to indicate no cache is available.
-        """
-        return None
-    
-    def is_cache_expired(self, chat_id, max_age_hours=None):
-        """
-        Stub method for compatibility - the current Gemini API doesn't support cache keys.
-        Always returns True to indicate cache should be considered expired.
-        """
-        return True 
\ No newline at end of file
+
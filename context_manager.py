@@ -1,20 +1,158 @@
+import atexit
+import functools
 import json
+import logging
 import os
 import re
-from datetime import datetime, timedelta
-from collections import defaultdict
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from collections import defaultdict, deque, namedtuple
+from itertools import islice
+
+import storage
+
+# Handlers and level are configured by the application (see main.py)
+log = logging.getLogger(__name__)
+
+# Debounce settings for writing memory to disk: flush at most once per interval,
+# unless enough mutations have piled up in the meantime
+FLUSH_INTERVAL_SECONDS = 30
+FLUSH_EVERY_N_MUTATIONS = 50
+
+# Upper bound for the per-chat memory lists, least recently mentioned entries are evicted first
+MAX_TOPICS = 100
+MAX_FACTS = 200
+MEMORY_LIST_LIMITS = {"topics_discussed": MAX_TOPICS, "important_facts": MAX_FACTS}
+
+# last_interaction is a coarse "chat was active" mark, rewrite it at most this often
+LAST_INTERACTION_RESOLUTION_SECONDS = 30
+
+# How many of a user's latest messages are kept as the sample for their impression
+IMPRESSION_SAMPLE_SIZE = 50
+# Upper bound for the impression bookkeeping (user_impressions / last_impression_update),
+# the users whose impression data was refreshed longest ago are dropped first
+MAX_IMPRESSION_ENTRIES = 1000
+
+# Non-chat state saved as rows of the "state" table in memory.db: row id -> ContextManager attribute.
+# The row ids are the section names memory.json used
+STATE_SECTIONS = {
+    "active_sessions": "active_sessions",
+    "user_impressions_data": "user_impressions",
+    "last_impression_update": "last_impression_update",
+    "last_interactions": "last_interactions"
+}
+# Sections keyed by (chat_id, user_id) tuples in memory. JSON and msgpack maps cannot have
+# tuple keys, so the rows keep the "chat_id:user_id" strings memory.json used
+_PAIR_KEYED_SECTIONS = {"user_impressions_data", "last_impression_update"}
+
+def _encode_section(section, data):
+    """Copy of a state section ready to be stored as a row"""
+    if section in _PAIR_KEYED_SECTIONS:
+        # list() copies the items in one step, other threads may add entries meanwhile
+        return {f"{chat_id}:{user_id}": value for (chat_id, user_id), value in list(data.items())}
+    return dict(data)
+
+def _decode_section(section, data):
+    """Inverse of _encode_section"""
+    if section in _PAIR_KEYED_SECTIONS:
+        return {tuple(key.split(":", 1)): value for key, value in data.items()}
+    return data
+
+# Rules used by _auto_detect_important_info: (pattern, memory category, info type, ignore case).
+# Every pattern has exactly one capturing group holding the detected value
+_DETECTION_RULES = [
+    # Personal information patterns (name, age, location, etc.)
+    # Name patterns
+    (r"(?:мене|я) (?:звати|звуть|кличуть|називають|називаюсь) (\w+)", "user_info", "ім'я", True),
+    (r"(?:моє|мене) (?:ім'я|звати|звуть) (\w+)", "user_info", "ім'я", True),
+    # Age patterns
+    (r"(?:мені|я маю|мій вік) (\d+) (?:рок[иіу]в|літ|років)", "user_info", "вік", True),
+    # Location patterns
+    (r"(?:я|ми) (?:живу|живемо|мешкаю|з) (?:в|у) ([\w\s]+)", "user_info", "місце", True),
+    # Interest patterns
+    (r"(?:я|мені) (?:подобається|люблю|обожнюю) ([\w\s]+)", "user_info", "інтереси", True),
+    (r"(?:моє|мені) (?:хобі|захоплення) (?:це|—|-)? ?([\w\s]+)", "user_info", "хобі", True),
+    # Topic detection patterns
+    (r"(?:давай|можемо|хочу|цікавить|поговоримо|розкажи) про ([\w\s]+)", "topics_discussed", None, True),
+    (r"(?:мене цікавить тема|тема|питання щодо) ([\w\s]+)", "topics_discussed", None, True),
+    (r"(?:що ти думаєш про|як щодо|твоя думка про) ([\w\s]+)", "topics_discussed", None, True),
+    # Important fact patterns (case-sensitive, the fact is stored as written)
+    (r"(?:важливо|запам'ятай|не забудь|нагадую|важливий факт)[,:] (.*)", "important_facts", None, False),
+    (r"(?:запам'ятай|збережи|занотуй)[,:] (.*)", "important_facts", None, False),
+    (r"(?:я хочу щоб ти знала|тобі варто знати)[,:] (.*)", "important_facts", None, False)
+]
+
+# Minimum length of a detected value for it to count as meaningful content
+_MIN_VALUE_LENGTH = {"user_info": 2, "topics_discussed": 3, "important_facts": 4}
+
+# Every rule compiled once. Case-insensitive rules run on the lowercased message, like the
+# original per-rule re.search calls, so the values come out lowercased
+_COMPILED_DETECTION_RULES = [
+    (re.compile(pattern), category, info_type, ignore_case)
+    for pattern, category, info_type, ignore_case in _DETECTION_RULES
+]
+
+# All rules fused into one alternation, used only to tell whether any rule can match.
+# It can't replace the per-rule searches: leftmost matches consume the text, so a rule whose
+# match overlaps another one's would be lost. Searched on the lowercased message, which every
+# rule that matches the original text matches as well.
+# Stdlib re is used on purpose: RE2's \w is ASCII-only and would miss Cyrillic words
+_DETECTION_PATTERN = re.compile("|".join(f"(?:{pattern})" for pattern, _, _, _ in _DETECTION_RULES))
+
+# Cheap pre-check before _DETECTION_PATTERN: every rule needs at least one of these
+# substrings in the lowercased message, so a message containing none of them cannot match
+_TRIGGER_SUBSTRINGS = (
+    "звати", "звуть", "кличуть", "називають", "називаюсь", "ім'я",
+    "рок", "літ",
+    "живу", "живемо", "мешкаю", "з в", "з у",
+    "подобається", "люблю", "обожнюю", "хобі", "захоплення",
+    "про", "тема", "щодо",
+    "важлив", "запам'ятай", "не забудь", "нагадую", "збережи", "занотуй", "знала", "варто знати"
+)
+
+# Shortest message any rule can match with a value that passes _MIN_VALUE_LENGTH ("я з в xx")
+_MIN_DETECTABLE_LENGTH = 8
+
+# Telegram ids arrive as ints and are used as string keys everywhere. A bot sees a bounded set of
+# chats and users, so the strings are cached: no new object per call, and every dict shares one copy.
+# typed=True keeps e.g. 1 and 1.0 apart, str() gives them different keys
+_id_str = functools.lru_cache(maxsize=4096, typed=True)(str)
+
+# One history entry. A tuple takes about a third of the memory of the equivalent dict,
+# which adds up over max_messages entries per chat. History is in-process only, never persisted
+Message = namedtuple("Message", ["timestamp", "user_id", "username", "content", "is_bot"])
 
 class ContextManager:
     """
     Manages conversation context and long-term memory for the chatbot
     """
-    def __init__(self, max_messages=250, memory_file="memory.json", session_timeout_seconds=300):
+    def __init__(self, max_messages=250, memory_file="memory.json", session_timeout_seconds=300, durable=False):
         self.max_messages = max_messages
+        # Sync memory.db to disk on every commit (synchronous=FULL); off by default, WAL never corrupts the file
+        self.durable = durable
         # Use /memory directory for storage
         self.memory_dir = "/memory"
         self.memory_file = os.path.join(self.memory_dir, memory_file)
-        self.conversations = defaultdict(list)
-        self.memory = self._load_memory()
+        # Bounded history per chat: deque evicts the oldest message in O(1) once max_messages is reached
+        self.conversations = defaultdict(lambda: deque(maxlen=self.max_messages))
+        # Total messages seen per chat since start, keeps growing after the history is capped
+        self._total_counts = defaultdict(int)
+        # chat_id -> ids of the users who wrote in the chat since start, see is_group_chat
+        self._chat_user_ids = defaultdict(set)
+        # Per-user index next to the history, filled by add_message so user queries skip the scan:
+        # (chat_id, user_id) -> number of messages since start / that user's latest message entries
+        self._user_msg_counts = defaultdict(int)
+        self._user_recent_msgs = defaultdict(lambda: deque(maxlen=IMPRESSION_SAMPLE_SIZE))
+        # chat_id -> (total message count, formatted history), see get_conversation_context
+        self._context_cache = {}
+        # (chat_id, category) -> (list, set of its values), see _seen_values
+        self._seen_index = {}
+        # Memory lives in SQLite next to memory_file, per-chat memory is fetched per chat on demand.
+        # memory_file itself is only read to migrate older installs
+        self.memory_db = os.path.splitext(self.memory_file)[0] + ".db"
         # Зберігання активних сесій розмови в групових чатах
         self.active_sessions = {}
         # Час в секундах, після якого сесія розмови в групі вважається закінченою
@@ -23,154 +161,300 @@ class ContextManager:
         self.user_impressions = {}
         # Останнє оновлення вражень про користувачів (останні 250 повідомлень)
         self.last_impression_update = {}
+        # (chat_id, user_id) keys of user_impressions entries with needs_generation set
+        self._pending_impressions = set()
         # Flag to track if memory needs saving
         self._dirty = False
+        # STATE_SECTIONS rows changed since the last save, only these are written.
+        # Added to from the Flask and worker threads while the writer swaps it out, so
+        # every access goes through _dirty_sections_lock
+        self._dirty_sections = set()
+        self._dirty_sections_lock = threading.Lock()
+        # chat_id -> last_interaction of every chat, so finding the recently active chats
+        # does not load every chat row from the store
+        self.last_interactions = {}
+        # chat_id -> monotonic time last_interaction was last written, see _touch_last_interaction
+        self._last_interaction_marks = {}
+        # How many dirty marks were skipped because nothing changed (for debugging the save rate)
+        self._dirty_marks_skipped = 0
+        # Debounce state for _maybe_flush
+        self._last_flush = time.monotonic()
+        self._pending_mutations = 0
+        # Saves can come from the worker, the periodic save thread and atexit at the same time
+        self._save_lock = threading.Lock()
+        # Single background thread for the CPU part of add_message, keeps the order of messages
+        self._worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix="context-worker")
+        # Saves are done by the writer thread; _maybe_flush only sets this event
+        self._flush_requested = threading.Event()
+        # Loaded after the defaults above so the restored sessions and impressions are kept
+        self.memory = self._load_memory()
+        self._pending_impressions = {user_key for user_key, data in self.user_impressions.items()
+                                     if data.get("needs_generation", False)}
         # Track if the memory has been loaded successfully
-        self._memory_loaded = os.path.exists(self.memory_file)
+        self._memory_loaded = len(self.memory) > 0 or len(self._state) > 0
+        self._writer = threading.Thread(target=self._writer_loop, name="context-writer", daemon=True)
+        self._writer.start()
+        # Make sure pending changes are not lost on shutdown
+        atexit.register(self._maybe_flush, force=True)
     
     def _load_memory(self):
-        """Load memory from file if it exists"""
-        if os.path.exists(self.memory_file):
+        """Open the memory stores and restore sessions and impressions, migrating memory_file if needed"""
+        memory = storage.SqliteStore(self.memory_db, durable=self.durable)
+        self._state = storage.SqliteStore(self.memory_db, table="state", durable=self.durable)
+        if len(self._state) > 0:
+            for section, attr in STATE_SECTIONS.items():
+                if section in self._state:
+                    setattr(self, attr, _decode_section(section, self._state[section]))
+            log.info("Successfully loaded memory from %s", self.memory_db)
+        elif os.path.exists(self.memory_file):
             try:
-                with open(self.memory_file, 'r', encoding='utf-8') as f:
-                    loaded_data = json.load(f)
+                with open(self.memory_file, 'rb') as f:
+                    loaded_data = storage.loads(f.read())
                     # Restore relevant parts if they exist in the file
                     self.active_sessions = loaded_data.get("active_sessions", {})
-                    self.user_impressions = loaded_data.get("user_impressions_data", {})
-                    self.last_impression_update = loaded_data.get("last_impression_update", {})
-                    print(f"[ContextManager] Successfully loaded memory from {self.memory_file}")
-                    return loaded_data.get("memory", {})
+                    self.user_impressions = _decode_section(
+                        "user_impressions_data", loaded_data.get("user_impressions_data", {}))
+                    self.last_impression_update = _decode_section(
+                        "last_impression_update", loaded_data.get("last_impression_update", {}))
+                    # Older memory.json files keep every chat under "memory" - move them to the store once
+                    legacy_memory = loaded_data.get("memory")
+                    if legacy_memory:
+                        for chat_id, chat_memory in legacy_memory.items():
+                            if chat_id not in memory:
+                                memory[chat_id] = chat_memory
+                    # Written to memory.db on the next save, memory_file is not read after that
+                    with self._dirty_sections_lock:
+                        self._dirty_sections.update(STATE_SECTIONS)
+                    self._dirty = True
+                    log.info("Migrating %s to %s", self.memory_file, self.memory_db)
             except json.JSONDecodeError as e:
-                print(f"Error decoding JSON from memory file {self.memory_file}: {str(e)}. Starting with empty memory.")
+                log.error("Error decoding JSON from memory file %s: %s. Starting with empty memory.", self.memory_file, e)
             except Exception as e:
-                print(f"Error loading memory from {self.memory_file}: {str(e)}. Starting with empty memory.")
+                log.error("Error loading memory from %s: %s. Starting with empty memory.", self.memory_file, e)
         else:
-            print(f"[ContextManager] Memory file {self.memory_file} not found. Starting with empty memory.")
-        # Return default empty structure if loading fails or file doesn't exist
-        return {}
+            log.info("No saved memory in %s. Starting with empty memory.", self.memory_db)
+        # Message counts are kept in memory only and start from 0 again, so the saved counts of
+        # the last impression update are moved to 0 as well: the next update comes after 30 new
+        # messages instead of waiting until the count from before the restart is reached again
+        self.last_impression_update = {key: 0 for key in self.last_impression_update}
+        if "last_interactions" not in self._state and len(memory) > 0:
+            # Saved before the index existed (or just migrated) - build it once from the chat rows
+            self._rebuild_last_interactions(memory)
+        return memory
+    
+    def _rebuild_last_interactions(self, memory):
+        """Fill last_interactions from the chat rows, without keeping the rows in memory"""
+        self.last_interactions = {chat_id: chat_memory["last_interaction"]
+                                  for chat_id, chat_memory in memory.scan()
+                                  if chat_memory.get("last_interaction")}
+        self._mark_state_dirty("last_interactions")
+    
+    def get_last_interactions(self):
+        """Copy of chat_id -> ISO time of the chat's last interaction"""
+        return dict(self.last_interactions)
+    
+    def dump_pretty(self, path):
+        """
+        Write all chats and state sections to path as indented JSON, in the layout of the old memory.json.
+        For manual inspection only - memory.db keeps compact rows and this loads every chat
+        """
+        data = {section: _encode_section(section, getattr(self, attr)) for section, attr in STATE_SECTIONS.items()}
+        data["memory"] = {chat_id: self.memory[chat_id] for chat_id in self.memory}
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
     
     def save_memory_if_dirty(self):
-        """Save memory to file only if changes have been made"""
+        """Save memory to disk only if changes have been made"""
         if not self._dirty:
             return False
-        try:
-            # Ensure the directory exists
-            os.makedirs(os.path.dirname(self.memory_file), exist_ok=True)
-
-            # Prepare data to save - include memory and other relevant state
-            data_to_save = {
-                "memory": self.memory,
-                "active_sessions": self.active_sessions,
-                "user_impressions_data": self.user_impressions,
-                "last_impression_update": self.last_impression_update,
-                "last_saved": datetime.now().isoformat()
-            }
+        with self._save_lock:
+            return self._save_memory_locked()
 
-            with open(self.memory_file, 'w', encoding='utf-8') as f:
-                json.dump(data_to_save, f, ensure_ascii=False, indent=2)
-            # Reset dirty flag after successful save
-            self._dirty = False
-            print(f"[ContextManager] Memory saved to {self.memory_file}")
+    def _save_memory_locked(self):
+        """Body of save_memory_if_dirty, runs under _save_lock"""
+        if not self._dirty:
+            return False
+        # Cleared before the snapshot so changes made while writing mark memory dirty again
+        self._dirty = False
+        with self._dirty_sections_lock:
+            sections = self._dirty_sections
+            self._dirty_sections = set()
+        try:
+            # Each save is a small transaction appended to the SQLite WAL instead of a rewrite
+            # of the whole memory; SQLite folds the WAL back into the database on checkpoints
+            self.memory.flush()
+            for section in sections:
+                # Shallow copy taken in one step, so sessions or impressions added by other
+                # threads while the row is being encoded cannot break the encoding
+                self._state[section] = _encode_section(section, getattr(self, STATE_SECTIONS[section]))
+            self._state.flush()
+            # Reset debounce state after successful save
+            self._last_flush = time.monotonic()
+            self._pending_mutations = 0
+            log.info("Memory saved to %s", self.memory_db)
             return True
         except Exception as e:
-            print(f"Error saving memory to {self.memory_file}: {str(e)}")
+            with self._dirty_sections_lock:
+                self._dirty_sections |= sections
+            self._dirty = True
+            log.error("Error saving memory to %s: %s", self.memory_db, e)
             return False
     
-    # Keep internal _save_memory for explicit calls if needed elsewhere,
-    # but it's primarily replaced by save_memory_if_dirty for background tasks
-    def _save_memory(self):
-        """Internal method to force save memory, used cautiously."""
-        self._dirty = True # Ensure it saves if called directly
-        return self.save_memory_if_dirty()
+    def _maybe_flush(self, force=False):
+        """
+        Ask the writer thread to save memory if it is dirty and the debounce window has passed.
+        Called at the end of public mutators so bursts of messages collapse into a single write.
+        Only force=True saves in the calling thread; returns True if it saved right now
+        """
+        if not self._dirty:
+            return False
+        if force:
+            return self.save_memory_if_dirty()
+        self._pending_mutations += 1
+        if (time.monotonic() - self._last_flush >= FLUSH_INTERVAL_SECONDS or
+                self._pending_mutations >= FLUSH_EVERY_N_MUTATIONS):
+            self._flush_requested.set()
+        return False
+
+    def _writer_loop(self):
+        """
+        Background writer: saves when _maybe_flush asks for it, and at least every
+        FLUSH_INTERVAL_SECONDS otherwise, so changes of an idle bot still reach the disk.
+        Requests that arrive during a save collapse into the next one
+        """
+        while True:
+            self._flush_requested.wait(FLUSH_INTERVAL_SECONDS)
+            self._flush_requested.clear()
+            self.save_memory_if_dirty()
+
+    # Kept for callers outside this class (ContextCache, memory commands).
+    # It no longer writes on every call - the write is debounced via _maybe_flush
+    def _save_memory(self, chat_id=None):
+        """
+        Mark memory as changed and flush it if the debounce window has passed.
+        Pass chat_id when that chat's memory was changed in place, so its row is written
+        """
+        if chat_id is not None:
+            self.memory.mark_dirty(_id_str(chat_id))
+        else:
+            # The caller does not say what changed, save every section to be safe
+            with self._dirty_sections_lock:
+                self._dirty_sections.update(STATE_SECTIONS)
+        self._dirty = True
+        return self._maybe_flush()
+
+    def _mark_chat_dirty(self, chat_id_str):
+        """Mark one chat's memory as changed, only changed chats are written on flush"""
+        self.memory.mark_dirty(chat_id_str)
+        self._dirty = True
+
+    def _mark_state_dirty(self, section):
+        """Mark one of STATE_SECTIONS as changed, only changed sections are written on flush"""
+        with self._dirty_sections_lock:
+            self._dirty_sections.add(section)
+        self._dirty = True
     
     def add_message(self, chat_id, user_id, username, message, is_bot=False, is_group=False):
         """Add a message to the conversation context"""
-        chat_id_str = str(chat_id)  # Convert to string to ensure compatibility as dict key
+        chat_id_str = _id_str(chat_id)  # Convert to string to ensure compatibility as dict key
+        # One clock read for the whole call. History entries keep the raw integer (epoch nanoseconds),
+        # the ISO string is only built for the persisted last_interaction fields below
+        now_ns = time.time_ns()
+        now_iso = datetime.fromtimestamp(now_ns / 1e9).isoformat()
+        # Every message of a user carries the same username, share one string object between them
+        if username:
+            username = sys.intern(username)
         
         # Create message entry
-        message_entry = {
-            "timestamp": datetime.now().isoformat(),
-            "user_id": user_id,
-            "username": username,
-            "content": message,
-            "is_bot": is_bot
-        }
+        message_entry = Message(now_ns, user_id, username, message, is_bot)
         
-        # Add to conversation history
+        # Add to conversation history (the deque drops the oldest message when full)
         self.conversations[chat_id_str].append(message_entry)
-        
-        # Trim conversation if needed
-        if len(self.conversations[chat_id_str]) > self.max_messages:
-            self.conversations[chat_id_str] = self.conversations[chat_id_str][-self.max_messages:]
+        self._total_counts[chat_id_str] += 1
+        if not is_bot and user_id:
+            self._chat_user_ids[chat_id_str].add(user_id)
+            user_key = (chat_id_str, _id_str(user_id))
+            self._user_msg_counts[user_key] += 1
+            self._user_recent_msgs[user_key].append(message_entry)
         
         # Update memory structures for this chat
-        self._update_memory(chat_id_str) # This now only updates in-memory dicts and sets _dirty flag
+        self._update_memory(chat_id_str, now_iso) # This now only updates in-memory dicts and sets _dirty flag
 
-        # Auto-detect and save important information
         if not is_bot:
-            self._auto_detect_important_info(chat_id_str, user_id, message) # Pass user_id here
-            
             # Check if we have enough messages from this user to generate/update an impression
-            self._maybe_update_user_impression(chat_id_str, user_id, username)
+            self._maybe_update_user_impression(chat_id_str, user_id, username, now_iso)
         
-        # Mark memory as dirty - saving will happen later periodically
-        self._dirty = True
+        # Memory is marked dirty by the updates above only if they changed something.
+        # Detection runs on the worker and the save on the writer thread, the caller only needs message_entry
+        self._worker.submit(self._process_message_in_background, chat_id_str, user_id, message, is_bot, now_iso)
         
         return message_entry
+
+    def _process_message_in_background(self, chat_id, user_id, message, is_bot, now_iso):
+        """Worker part of add_message: auto-detect important information and request a flush if due"""
+        try:
+            if not is_bot:
+                self._auto_detect_important_info(chat_id, user_id, message, now_iso)
+            self._maybe_flush()
+        except Exception as e:
+            log.error("Background processing failed for chat %s: %s", chat_id, e)
     
     def is_group_chat(self, chat_id):
         """Checks if a given chat_id corresponds to a group chat based on stored history"""
         # This is an approximation. A better way would be to store chat type when first seen.
         # Let's assume if we have multiple non-bot user IDs, it's likely a group.
-        chat_id_str = str(chat_id)
-        user_ids = set()
-        for msg in self.conversations.get(chat_id_str, []):
-            if not msg.get("is_bot") and msg.get("user_id"):
-                user_ids.add(msg.get("user_id"))
-        return len(user_ids) > 1
+        # The ids are collected in add_message, so this is a lookup instead of a history scan
+        return len(self._chat_user_ids.get(_id_str(chat_id), ())) > 1
         
     def is_session_active(self, chat_id, user_id=None):
         """
         Перевіряє, чи є активна сесія розмови в поточному чаті.
         Якщо user_id вказано, перевіряє чи бере користувач участь в активній сесії.
         """
-        chat_id_str = str(chat_id)
+        chat_id_str = _id_str(chat_id)
+        session = self.active_sessions.get(chat_id_str)
         
         # Якщо сесії немає, то вона не активна
-        if chat_id_str not in self.active_sessions:
+        if session is None:
             return False
         
-        session = self.active_sessions[chat_id_str]
-        
         # Перевіряємо час останньої активності
-        last_activity = datetime.fromisoformat(session["last_activity"])
-        if datetime.now() - last_activity > timedelta(seconds=self.session_timeout):
+        last_activity_ts = session.get("last_activity_ts")
+        if last_activity_ts is None:
+            # Сесії, збережені до появи last_activity_ts, мають лише ISO-рядок
+            last_activity_ts = datetime.fromisoformat(session["last_activity"]).timestamp()
+            session["last_activity_ts"] = last_activity_ts
+        if time.time() - last_activity_ts > self.session_timeout:
             # Сесія закінчилась через timeout
             del self.active_sessions[chat_id_str]
+            self._mark_state_dirty("active_sessions")
             return False
         
         # Якщо user_id вказано, перевіряємо чи є користувач в учасниках сесії
         if user_id is not None:
-            return str(user_id) in session["participants"]
+            return _id_str(user_id) in session["participants"]
         
-        # Сесія активна
-        self._dirty = True # Session access updates activity, mark dirty
+        # Сесія активна. Перевірка нічого не змінює, тому сесії не позначаються як змінені
         return True
     
     def start_session(self, chat_id, user_id, username):
         """
         Починає нову сесію розмови в груповому чаті.
         """
-        chat_id_str = str(chat_id)
-        user_id_str = str(user_id)
+        chat_id_str = _id_str(chat_id)
+        user_id_str = _id_str(user_id)
+        now = datetime.now()
         
+        # ISO-рядок для читабельності файлу, epoch-секунди для швидкого порівняння
         self.active_sessions[chat_id_str] = {
-            "last_activity": datetime.now().isoformat(),
+            "last_activity": now.isoformat(),
+            "last_activity_ts": now.timestamp(),
             "participants": {user_id_str: username},
             "starter": user_id_str
         }
         
-        self._dirty = True # Mark memory as dirty
+        self._mark_state_dirty("active_sessions")
+        self._maybe_flush()
         return True
     
     def update_session(self, chat_id, user_id, username):
@@ -180,31 +464,39 @@ class ContextManager:
         if not self.is_session_active(chat_id):
             return False
         
-        chat_id_str = str(chat_id)
-        user_id_str = str(user_id)
+        chat_id_str = _id_str(chat_id)
+        user_id_str = _id_str(user_id)
+        
+        session = self.active_sessions[chat_id_str]
         
         # Оновлюємо час останньої активності
-        self.active_sessions[chat_id_str]["last_activity"] = datetime.now().isoformat()
+        now = datetime.now()
+        session["last_activity"] = now.isoformat()
+        session["last_activity_ts"] = now.timestamp()
         
         # Додаємо користувача до учасників, якщо він ще не в списку
-        self.active_sessions[chat_id_str]["participants"][user_id_str] = username
+        session["participants"][user_id_str] = username
         
-        self._dirty = True # Mark memory as dirty
+        self._mark_state_dirty("active_sessions")
+        self._maybe_flush()
         return True
     
     def end_session(self, chat_id):
         """
         Примусово завершує сесію розмови.
         """
-        chat_id_str = str(chat_id)
+        chat_id_str = _id_str(chat_id)
         if chat_id_str in self.active_sessions:
             del self.active_sessions[chat_id_str]
-            self._dirty = True # Mark memory as dirty
+            self._mark_state_dirty("active_sessions")
+            # A finished conversation is a natural checkpoint, have it written out right away
+            self._flush_requested.set()
             return True
         return False
     
-    def _update_memory(self, chat_id):
+    def _update_memory(self, chat_id, now_iso=None):
         """Extract important information from conversations to update memory"""
+        changed = False
         if chat_id not in self.memory:
             self.memory[chat_id] = {
                 "user_info": {},
@@ -213,102 +505,134 @@ class ContextManager:
                 "user_impressions": {},
                 "last_interaction": None
             }
-        
-        # Update the last interaction time
-        self.memory[chat_id]["last_interaction"] = datetime.now().isoformat()
+            changed = True
+        chat_memory = self.memory[chat_id]
         
         # Make sure user_impressions exists in memory
-        if "user_impressions" not in self.memory[chat_id]:
-            self.memory[chat_id]["user_impressions"] = {}
-            
-        self._dirty = True # Mark memory as dirty since last_interaction changed
+        if "user_impressions" not in chat_memory:
+            chat_memory["user_impressions"] = {}
+            changed = True
+        
+        # Update the last interaction time
+        if self._touch_last_interaction(chat_id, chat_memory, now_iso) or changed:
+            self._mark_chat_dirty(chat_id)
     
-    def _auto_detect_important_info(self, chat_id, user_id, message):
+    def _touch_last_interaction(self, chat_id_str, chat_memory, now_iso=None):
+        """
+        Set last_interaction, but at most once per LAST_INTERACTION_RESOLUTION_SECONDS per chat,
+        so a busy chat does not turn every message into a save. Returns True if it was updated
+        """
+        now = time.monotonic()
+        last_mark = self._last_interaction_marks.get(chat_id_str)
+        if (last_mark is not None and chat_memory.get("last_interaction") and
+                now - last_mark < LAST_INTERACTION_RESOLUTION_SECONDS):
+            self._dirty_marks_skipped += 1
+            return False
+        chat_memory["last_interaction"] = self.last_interactions[chat_id_str] = now_iso or datetime.now().isoformat()
+        self._last_interaction_marks[chat_id_str] = now
+        self._mark_state_dirty("last_interactions")
+        return True
+    
+    def _auto_detect_important_info(self, chat_id, user_id, message, now_iso=None):
         """
         Automatically detect important information from a message
         This is a simple rule-based detection that can be improved with ML models
         """
-        # Initialize patterns for different types of information
-        # Personal information patterns (name, age, location, etc.)
-        personal_info_patterns = [
-            # Name patterns
-            (r"(?:мене|я) (?:звати|звуть|кличуть|називають|називаюсь) (\w+)", "ім'я"),
-            (r"(?:моє|мене) (?:ім'я|звати|звуть) (\w+)", "ім'я"),
-            # Age patterns
-            (r"(?:мені|я маю|мій вік) (\d+) (?:рок[иіу]в|літ|років)", "вік"),
-            # Location patterns
-            (r"(?:я|ми) (?:живу|живемо|мешкаю|з) (?:в|у) ([\w\s]+)", "місце"),
-            # Interest patterns
-            (r"(?:я|мені) (?:подобається|люблю|обожнюю) ([\w\s]+)", "інтереси"),
-            (r"(?:моє|мені) (?:хобі|захоплення) (?:це|—|-)? ?([\w\s]+)", "хобі")
-        ]
-        
-        # Topic detection patterns
-        topic_patterns = [
-            r"(?:давай|можемо|хочу|цікавить|поговоримо|розкажи) про ([\w\s]+)",
-            r"(?:мене цікавить тема|тема|питання щодо) ([\w\s]+)",
-            r"(?:що ти думаєш про|як щодо|твоя думка про) ([\w\s]+)"
-        ]
-        
-        # Important fact patterns
-        fact_patterns = [
-            r"(?:важливо|запам'ятай|не забудь|нагадую|важливий факт)[,:] (.*)",
-            r"(?:запам'ятай|збережи|занотуй)[,:] (.*)",
-            r"(?:я хочу щоб ти знала|тобі варто знати)[,:] (.*)"
-        ]
-        
-        # Pass user_id to add_to_memory if needed later
-        # Check for personal information
-        for pattern, info_type in personal_info_patterns:
-            matches = re.search(pattern, message.lower())
-            if matches:
-                value = matches.group(1).strip()
-                if value and len(value) > 1:  # Ensure we have meaningful content
-                    # Add info associated with the user if possible
-                    self.add_to_memory(chat_id, "user_info", {info_type: value}, user_id=user_id)
-                    self._dirty = True
-        
-        # Check for topics
-        for pattern in topic_patterns:
-            matches = re.search(pattern, message.lower())
-            if matches:
-                topic = matches.group(1).strip()
-                if topic and len(topic) > 2:  # Ensure we have meaningful content
-                    self.add_to_memory(chat_id, "topics_discussed", topic)
-                    self._dirty = True
-        
-        # Check for important facts
-        for pattern in fact_patterns:
-            matches = re.search(pattern, message)
-            if matches:
-                fact = matches.group(1).strip()
-                if fact and len(fact) > 3:  # Ensure we have meaningful content
-                    self.add_to_memory(chat_id, "important_facts", fact)
-                    self._dirty = True # Mark memory as dirty
+        # Most messages are short chatter - skip them before touching the regex engine
+        if len(message) < _MIN_DETECTABLE_LENGTH:
+            return
+        lowered = message.lower()
+        if not any(trigger in lowered for trigger in _TRIGGER_SUBSTRINGS):
+            return
+
+        # One scan decides whether the rules have to run at all
+        if _DETECTION_PATTERN.search(lowered) is None:
+            return
+
+        for pattern, category, info_type, ignore_case in _COMPILED_DETECTION_RULES:
+            matches = pattern.search(lowered if ignore_case else message)
+            if matches is None:
+                continue
+            value = matches.group(1).strip()
+            if len(value) < _MIN_VALUE_LENGTH[category]:  # Ensure we have meaningful content
+                continue
+
+            if category == "user_info":
+                # Add info associated with the user if possible
+                self.add_to_memory(chat_id, "user_info", {info_type: value}, user_id=user_id, now_iso=now_iso)
+            else:
+                self.add_to_memory(chat_id, category, value, now_iso=now_iso)
     
     def get_conversation_context(self, chat_id):
         """Get formatted conversation history for the given chat"""
-        chat_id_str = str(chat_id)
+        chat_id_str = _id_str(chat_id)
         
-        if chat_id_str not in self.conversations or not self.conversations[chat_id_str]:
-            return ""
+        # The formatted history only changes when a message is added, which bumps the total count
+        total = self._total_counts.get(chat_id_str, 0)
+        cached = self._context_cache.get(chat_id_str)
+        if cached is not None and cached[0] == total:
+            return cached[1]
         
-        formatted_context = "Previous conversation:\n\n"
-        for msg in self.conversations[chat_id_str]:
-            speaker = "Bot" if msg["is_bot"] else f"User ({msg['username'] if msg['username'] else 'Unknown'})"
-            formatted_context += f"{speaker}: {msg['content']}\n"
+        history = self.conversations.get(chat_id_str)
+        if not history:
+            return ""
         
+        formatted_context = "Previous conversation:\n\n" + self.format_messages(history)
+        self._context_cache[chat_id_str] = (total, formatted_context)
         return formatted_context
     
+    def get_total_message_count(self, chat_id):
+        """Get how many messages were added to a chat, including ones already evicted from history"""
+        return self._total_counts.get(_id_str(chat_id), 0)
+
+    def get_messages_since(self, chat_id, start_index):
+        """
+        Get the messages still in history whose position in the chat is start_index or later.
+        Positions count every message since start, like get_total_message_count
+        """
+        chat_id_str = _id_str(chat_id)
+        history = self.conversations.get(chat_id_str)
+        if not history:
+            return []
+        first_index = self._total_counts[chat_id_str] - len(history)
+        return list(islice(history, max(0, start_index - first_index), None))
+
+    @staticmethod
+    def format_messages(messages):
+        """Format messages as "Speaker: text" lines, the same way get_conversation_context does"""
+        # A chat has only a handful of distinct speakers, format each label once
+        speakers = {}
+        lines = []
+        append = lines.append
+        for msg in messages:
+            key = (msg.is_bot, msg.username)
+            speaker = speakers.get(key)
+            if speaker is None:
+                speaker = "Bot" if msg.is_bot else f"User ({msg.username or 'Unknown'})"
+                speakers[key] = speaker
+            append(f"{speaker}: {msg.content}\n")
+        return "".join(lines)
+
+    def get_user_messages(self, chat_id, user_id):
+        """Get the latest messages (up to IMPRESSION_SAMPLE_SIZE) of one user in a chat, oldest first"""
+        return list(self._user_recent_msgs.get((_id_str(chat_id), _id_str(user_id)), ()))
+
+    def get_username(self, chat_id, user_id, default="Unknown"):
+        """Get the username a user last wrote with in a chat since start"""
+        recent = self._user_recent_msgs.get((_id_str(chat_id), _id_str(user_id)))
+        if recent and recent[-1].username:
+            return recent[-1].username
+        return default
+
     def get_memory(self, chat_id):
         """Get memory for a specific chat"""
-        chat_id_str = str(chat_id)
+        chat_id_str = _id_str(chat_id)
         return self.memory.get(chat_id_str, {})
     
-    def add_to_memory(self, chat_id, category, value, user_id=None):
+    def add_to_memory(self, chat_id, category, value, user_id=None, now_iso=None):
         """Manually add an important fact to memory"""
-        chat_id_str = str(chat_id)
-        user_id_str = str(user_id) if user_id else None
+        chat_id_str = _id_str(chat_id)
+        user_id_str = _id_str(user_id) if user_id else None
 
         if chat_id_str not in self.memory:
             self.memory[chat_id_str] = {
@@ -319,30 +643,53 @@ class ContextManager:
                 "users": {} # Store user-specific info here
             }
 
+        chat_memory = self.memory[chat_id_str]
+        changed = False
+
         # Initialize user-specific sub-dict if category is user_info and user_id is present
         if category == "user_info" and user_id_str:
-            if "users" not in self.memory[chat_id_str]:
-                self.memory[chat_id_str]["users"] = {}
-            if user_id_str not in self.memory[chat_id_str]["users"]:
-                 self.memory[chat_id_str]["users"][user_id_str] = {"user_info": {}}
-            if "user_info" not in self.memory[chat_id_str]["users"][user_id_str]:
-                 self.memory[chat_id_str]["users"][user_id_str]["user_info"] = {}
-            self.memory[chat_id_str]["users"][user_id_str]["user_info"].update(value)
-            self._dirty = True
-        elif category == "topics_discussed":
-            if value not in self.memory[chat_id_str]["topics_discussed"]:
-                self.memory[chat_id_str]["topics_discussed"].append(value)
-                self._dirty = True # Mark memory as dirty
-        elif category == "important_facts":
-            if value not in self.memory[chat_id_str]["important_facts"]:
-                self.memory[chat_id_str]["important_facts"].append(value)
-                self._dirty = True # Mark memory as dirty
+            users = chat_memory.setdefault("users", {})
+            user_entry = users.setdefault(user_id_str, {"user_info": {}})
+            user_info = user_entry.setdefault("user_info", {})
+            # Repeating a known detail (e.g. the same name again) is not a change
+            if any(user_info.get(key) != info for key, info in value.items()):
+                user_info.update(value)
+                changed = True
+        elif category in MEMORY_LIST_LIMITS:
+            seen = self._seen_values(chat_id_str, category)
+            values = chat_memory[category]
+            if value in seen:
+                # Re-mentioned value moves to the end so it is evicted last
+                if values[-1] != value:
+                    values.remove(value)
+                    values.append(value)
+                    changed = True
+            else:
+                seen.add(value)
+                values.append(value)
+                # Evict the least recently mentioned values once over the limit
+                while len(values) > MEMORY_LIST_LIMITS[category]:
+                    seen.discard(values.pop(0))
+                changed = True
         
         # Update last interaction time whenever memory is added
-        self.memory[chat_id_str]["last_interaction"] = datetime.now().isoformat()
-        self._dirty = True # Also mark dirty for last_interaction update
+        if self._touch_last_interaction(chat_id_str, chat_memory, now_iso) or changed:
+            self._mark_chat_dirty(chat_id_str)
+        self._maybe_flush()
     
-    def _maybe_update_user_impression(self, chat_id, user_id, username):
+    def _seen_values(self, chat_id_str, category):
+        """
+        Set mirror of a memory list (topics_discussed / important_facts) for O(1) duplicate checks.
+        Rebuilt from the list on first use and whenever the list object was replaced, e.g. by /memory clear
+        """
+        values = self.memory[chat_id_str].setdefault(category, [])
+        cached = self._seen_index.get((chat_id_str, category))
+        if cached is None or cached[0] is not values:
+            cached = (values, set(values))
+            self._seen_index[(chat_id_str, category)] = cached
+        return cached[1]
+
+    def _maybe_update_user_impression(self, chat_id, user_id, username, now_iso=None):
         """
         Check if we should generate or update an impression about a specific user
         based on their recent messages
@@ -350,79 +697,94 @@ class ContextManager:
         if not user_id:  # Skip if no user ID (e.g., for bot messages)
             return
             
-        chat_id_str = str(chat_id)
-        user_id_str = str(user_id)
+        chat_id_str = _id_str(chat_id)
+        user_id_str = _id_str(user_id)
         
-        # Get all messages from this user in this chat
-        user_messages = [
-            msg for msg in self.conversations[chat_id_str] 
-            if not msg["is_bot"] and str(msg.get("user_id", "")) == user_id_str
-        ]
+        # Counted by add_message in the per-user index
+        key = (chat_id_str, user_id_str)
+        message_count = self._user_msg_counts.get(key, 0)
         
         # If fewer than 10 messages, not enough to form an impression yet
-        if len(user_messages) < 10:
+        if message_count < 10:
             return
             
         # Check if we've already generated an impression recently
-        user_key = f"{chat_id_str}:{user_id_str}"
-        last_update = self.last_impression_update.get(user_key, None)
+        last_update = self.last_impression_update.get(key, None)
         
         # Generate a new impression if:
         # 1. We've never generated one before, or
         # 2. We have at least 30 new messages since the last update
         if (last_update is None or 
-            len(user_messages) - last_update >= 30):
+            message_count - last_update >= 30):
             
-            self._generate_user_impression(chat_id_str, user_id_str, username, user_messages)
+            self._generate_user_impression(chat_id_str, user_id_str, username, message_count, now_iso)
             # Update the counter for when we last generated an impression
-            self.last_impression_update[user_key] = len(user_messages)
-            self._dirty = True # Mark dirty as impression state changed
+            self.last_impression_update[key] = message_count
+            self._mark_state_dirty("last_impression_update") # Impression counter changed
     
-    def _generate_user_impression(self, chat_id, user_id, username, messages):
+    def _generate_user_impression(self, chat_id, user_id, username, message_count, now_iso=None):
         """
         Generate a personality-infused impression about a user based on their messages
         and save it to memory
         """
         # Get the existing impression if any
-        existing_impression = self.memory[chat_id].get("user_impressions", {}).get(user_id, "")
-        
-        # Prepare data to generate the impression
-        message_texts = [msg["content"] for msg in messages[-50:]]  # Use most recent 50 messages max
-        message_sample = "\n".join(message_texts)
-        
-        # Get message count
-        message_count = len(messages)
+        chat_memory = self.memory.get(chat_id)
+        existing_impression = chat_memory.get("user_impressions", {}).get(user_id, "") if chat_memory else ""
         
         # Build a prompt that will be used later with Gemini API
         # We're just storing the data here for now, the actual generation
-        # will happen when needed via the main.py
+        # will happen when needed via the main.py. The message sample is not copied here:
+        # get_user_impression_data builds it from the per-user index when it is needed
         impression_data = {
             "username": username,
             "message_count": message_count,
-            "sample": message_sample,
             "existing_impression": existing_impression,
             "needs_generation": True,
-            "last_updated": datetime.now().isoformat()
+            "last_updated": now_iso or datetime.now().isoformat()
         }
         
-        # Store the data for later processing
-        self.user_impressions[f"{chat_id}:{user_id}"] = impression_data
-        self._dirty = True # Mark dirty as impression data added/updated
+        # Store the data for later processing. Re-inserting the key moves it to the end,
+        # so the dict stays ordered from least to most recently refreshed
+        user_key = (chat_id, user_id)
+        self.user_impressions.pop(user_key, None)
+        self.user_impressions[user_key] = impression_data
+        self._pending_impressions.add(user_key)
+        while len(self.user_impressions) > MAX_IMPRESSION_ENTRIES:
+            stale_key = next(iter(self.user_impressions))
+            del self.user_impressions[stale_key]
+            self._pending_impressions.discard(stale_key)
+            # The user starts over with the 10 message threshold if they come back
+            self.last_impression_update.pop(stale_key, None)
+            self._mark_state_dirty("last_impression_update")
+        self._mark_state_dirty("user_impressions_data") # Impression data added/updated
     
     def get_user_impression_data(self, chat_id, user_id):
         """
         Get the data needed to generate an impression for a specific user
         Returns None if there's no data or impression needed
         """
-        user_key = f"{chat_id}:{user_id}"
-        return self.user_impressions.get(user_key, None)
+        user_key = (_id_str(chat_id), _id_str(user_id))
+        data = self.user_impressions.get(user_key, None)
+        if data is None:
+            return None
+        recent = self._user_recent_msgs.get(user_key)
+        if recent:
+            sample = "\n".join(msg.content for msg in recent)
+        else:
+            # Recent messages are not persisted, so after a restart only entries saved
+            # by older versions (which stored the sample) still have one
+            sample = data.get("sample")
+            if not sample:
+                # Stays queued until the user writes again, see get_users_needing_impressions
+                return None
+        return {**data, "sample": sample}
     
     def save_generated_impression(self, chat_id, user_id, impression):
         """
         Save a generated impression to memory
         """
-        chat_id_str = str(chat_id)
-        user_id_str = str(user_id)
+        chat_id_str = _id_str(chat_id)
+        user_id_str = _id_str(user_id)
         
         # Ensure the base memory structure for the chat exists
         if chat_id_str not in self.memory:
@@ -431,36 +793,39 @@ class ContextManager:
         # Ensure we have a user_impressions dictionary in memory for this chat
         if "user_impressions" not in self.memory[chat_id_str]:
             self.memory[chat_id_str]["user_impressions"] = {}
-            self._dirty = True # Mark dirty if we had to create the dict
+            self._mark_chat_dirty(chat_id_str) # Mark dirty if we had to create the dict
             
         # Save the impression
         if self.memory[chat_id_str]["user_impressions"].get(user_id_str) != impression:
             self.memory[chat_id_str]["user_impressions"][user_id_str] = impression
-            self._dirty = True # Mark dirty only if impression changed
+            self._mark_chat_dirty(chat_id_str) # Mark dirty only if impression changed
         
         # Mark as no longer needing generation in the separate tracking dict
-        user_key = f"{chat_id_str}:{user_id_str}"
-        if user_key in self.user_impressions:
-            if self.user_impressions[user_key].get("needs_generation", False):
-                 self.user_impressions[user_key]["needs_generation"] = False
-                 self._dirty = True # Mark dirty as generation state changed
+        self._clear_pending_impression((chat_id_str, user_id_str))
+
+        self._maybe_flush()
+    
+    def _clear_pending_impression(self, user_key):
+        """Mark the impression entry of a (chat_id, user_id) pair as no longer needing generation"""
+        self._pending_impressions.discard(user_key)
+        data = self.user_impressions.get(user_key)
+        if data is not None and data.get("needs_generation", False):
+            data["needs_generation"] = False
+            self._mark_state_dirty("user_impressions_data") # Generation state changed
             
     def get_user_impressions(self, chat_id):
         """
         Get all stored impressions for users in a chat
         """
-        chat_id_str = str(chat_id)
+        chat_id_str = _id_str(chat_id)
         return self.memory.get(chat_id_str, {}).get("user_impressions", {})
         
     def get_users_needing_impressions(self):
         """
         Return a list of chat_id, user_id pairs that need impression generation
         """
-        needs_impression = []
-        
-        for user_key, data in self.user_impressions.items():
-            if data.get("needs_generation", False):
-                chat_id, user_id = user_key.split(":")
-                needs_impression.append((chat_id, user_id))
-                
-        return needs_impression 
\ No newline at end of file
+        # Tracked as a set of (chat_id, user_id) pairs, so this does not walk every tracked user.
+        # Entries without messages to sample (queued before a restart) wait for the user's next
+        # message instead of taking a place in the batch
+        return [user_key for user_key in list(self._pending_impressions)
+                if user_key in self._user_recent_msgs or self.user_impressions.get(user_key, {}).get("sample")] 
\ No newline at end of file
@@ -6,19 +6,113 @@ This module handles global memory analysis including:
 """
 
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from global_memory import GlobalMemory
 from personality import PERSONALITY
+import storage
 
-# Initialize global memory
-global_memory = GlobalMemory()
+# The GlobalMemory the analyses work on. main injects its instance with set_global_memory; a second
+# instance created at import would open the same files and overwrite them with its own state
+global_memory = None
+_global_memory_lock = threading.Lock()
+
+def set_global_memory(memory):
+    """Use memory (the bot's GlobalMemory) for all analyses"""
+    global global_memory
+    global_memory = memory
+
+def get_global_memory():
+    """Return the shared GlobalMemory, created on first use when nothing was injected"""
+    global global_memory
+    if global_memory is None:
+        with _global_memory_lock:
+            if global_memory is None:
+                global_memory = GlobalMemory()
+    return global_memory
+
+
+# Gemini is asked to answer in JSON matching these schemas, so the reply is parsed with one loads call
+PROFILE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "personality": {"type": "STRING"},
+        "interests": {"type": "ARRAY", "items": {"type": "STRING"}},
+        "behavior_patterns": {"type": "ARRAY", "items": {"type": "STRING"}},
+        "relationship_with_bot": {"type": "STRING"}
+    },
+    "required": ["personality", "interests", "behavior_patterns", "relationship_with_bot"]
+}
+RELATIONSHIPS_SCHEMA = {
+    "type": "ARRAY",
+    "items": {
+        "type": "OBJECT",
+        "properties": {
+            "user_ids": {"type": "ARRAY", "items": {"type": "STRING"}},
+            "relationship_type": {"type": "STRING"},
+            "description": {"type": "STRING"}
+        },
+        "required": ["user_ids", "relationship_type", "description"]
+    }
+}
+
+# Constant parts of the analysis prompts, built once. Only the user data between them changes per call
+_PROFILE_PROMPT_PREFIX = """
+    As Анна, you now need to analyze a user you've interacted with across multiple chats. 
+    Create a personal profile about this user based on what you know. Your analysis should reflect 
+    how you (Анна) perceive this person - use your instincts, observations, and subjective impressions.
+    
+    User information:"""
+_PROFILE_PROMPT_SUFFIX = """
+    Create a JSON with these fields:
+    - personality (a brief, subjective description of this person's character from your perspective)
+    - interests (list of their likely interests based on messages)
+    - behavior_patterns (list of behavioral traits you've observed)
+    - relationship_with_bot (how they relate to you: "friendly", "hostile", "neutral", "formal", etc.)
+    
+    IMPORTANT: Base your assessment on your perspective as Anna. This is your personal view of this user.
+    """
+_RELATIONSHIP_PROMPT_PREFIX = """
+    As Анна, analyze the relationships between the users in this chat based on their interactions.
+    This is your subjective perception of how these people relate to each other.
+    
+    Users in this chat:"""
+_RELATIONSHIP_PROMPT_SUFFIX = """
+    Create a JSON array of relationship observations, where each entry contains:
+    - user_ids: array of IDs of users involved in this relationship
+    - relationship_type: (e.g., "friends", "rivals", "colleagues", "romantic", "neutral", "hostile")
+    - description: your subjective description of their relationship dynamic
+    
+    Focus only on relationships where you have enough data to make an observation.
+    If there's nothing notable about some users' interactions, don't include them.
+    Include 1-to-1 relationships and also group dynamics if relevant.
+    
+    IMPORTANT: This is from your perspective as Anna - these are your personal observations about how people interact.
+    """
+
+def _generate_text(client, prompt, response_schema):
+    """
+    Send prompt to Gemini and return the reply text.
+    The reply is JSON following response_schema
+    """
+    response = client.models.generate_content(
+        model="gemini-2.0-flash",
+        contents=prompt,
+        config={
+            "system_instruction": PERSONALITY,
+            "response_mime_type": "application/json",
+            "response_schema": response_schema
+        }
+    )
+    return response.text
 
 def generate_user_profile(user_id, client):
     """
     Generate a comprehensive user profile based on all their interactions
     across different chats
     """
-    user_data = global_memory.get_user_profile(user_id)
+    user_data = get_global_memory().get_user_profile(user_id)
     if not user_data:
         return None
     
@@ -32,14 +126,7 @@ def generate_user_profile(user_id, client):
     existing_behavior = existing_profile.get("behavior_patterns", [])
     
     # Build a prompt for generating the profile
-    prompt = f"""
-    {PERSONALITY}
-    
-    As Анна, you now need to analyze a user you've interacted with across multiple chats. 
-    Create a personal profile about this user based on what you know. Your analysis should reflect 
-    how you (Анна) perceive this person - use your instincts, observations, and subjective impressions.
-    
-    User information:
+    prompt = "".join((_PROFILE_PROMPT_PREFIX, f"""
     - Username: {username}
     - User ID: {user_id}
     - Total messages: {total_messages}
@@ -49,55 +136,18 @@ def generate_user_profile(user_id, client):
     - Personality: {existing_personality}
     - Interests: {', '.join(existing_interests)}
     - Behavior patterns: {', '.join(existing_behavior)}
-    
-    Create a JSON with these fields:
-    - personality (a brief, subjective description of this person's character from your perspective)
-    - interests (list of their likely interests based on messages)
-    - behavior_patterns (list of behavioral traits you've observed)
-    - relationship_with_bot (how they relate to you: "friendly", "hostile", "neutral", "formal", etc.)
-    
-    IMPORTANT: Base your assessment on your perspective as Anna. This is your personal view of this user.
-    """
+    """, _PROFILE_PROMPT_SUFFIX))
     
     try:
-        response = client.models.generate_content(
-            model="gemini-2.0-flash",
-            contents=prompt,
-        )
+        response_text = _generate_text(client, prompt, PROFILE_SCHEMA)
         
         # Process the response
         profile_data = {}
         try:
-            # Try to parse as JSON first
-            profile_text = response.text.strip()
-            profile_data = json.loads(profile_text)
+            profile_data = storage.loads(response_text)
         except json.JSONDecodeError:
-            # If not valid JSON, try to extract info from text
-            text = response.text.lower()
-            
-            # Extract personality
-            if "personality:" in text:
-                personality_section = text.split("personality:")[1].split("\n")[0]
-                profile_data["personality"] = personality_section.strip()
-            
-            # Extract interests
-            interests = []
-            if "interests:" in text:
-                interests_section = text.split("interests:")[1].split("\n")[0]
-                interests = [i.strip() for i in interests_section.strip().split(",")]
-                profile_data["interests"] = interests
-            
-            # Extract behavior patterns
-            behaviors = []
-            if "behavior patterns:" in text or "behavior_patterns:" in text:
-                behavior_section = text.split("behavior patterns:" if "behavior patterns:" in text else "behavior_patterns:")[1].split("\n")[0]
-                behaviors = [b.strip() for b in behavior_section.strip().split(",")]
-                profile_data["behavior_patterns"] = behaviors
-            
-            # Extract relationship
-            if "relationship with bot:" in text or "relationship_with_bot:" in text:
-                relationship_section = text.split("relationship with bot:" if "relationship with bot:" in text else "relationship_with_bot:")[1].split("\n")[0]
-                profile_data["relationship_with_bot"] = relationship_section.strip()
+            # Only a cut-off reply is not valid JSON anymore, keep the previous profile then
+            print(f"Error parsing user profile JSON: {response_text}")
         
         # Ensure all fields exist
         if "personality" not in profile_data:
@@ -110,7 +160,7 @@ def generate_user_profile(user_id, client):
             profile_data["relationship_with_bot"] = "neutral"
             
         # Save the profile
-        global_memory.save_user_profile(user_id, profile_data)
+        get_global_memory().save_user_profile(user_id, profile_data)
         return profile_data
         
     except Exception as e:
@@ -122,7 +172,7 @@ def generate_relationship_analysis(chat_id, client):
     Generate analysis of relationships between users in a specific chat
     """
     # Get users from this chat
-    users_in_chat = global_memory.get_chat_users(chat_id)
+    users_in_chat = get_global_memory().get_chat_users(chat_id)
     if not users_in_chat or len(users_in_chat) < 2:
         # Not enough users for relationship analysis
         return None
@@ -150,54 +200,23 @@ def generate_relationship_analysis(chat_id, client):
         for u in users_info
     ])
     
-    prompt = f"""
-    {PERSONALITY}
-    
-    As Анна, analyze the relationships between the users in this chat based on their interactions.
-    This is your subjective perception of how these people relate to each other.
-    
-    Users in this chat:
+    prompt = "".join((_RELATIONSHIP_PROMPT_PREFIX, f"""
     {users_text}
-    
-    Create a JSON array of relationship observations, where each entry contains:
-    - user_ids: array of IDs of users involved in this relationship
-    - relationship_type: (e.g., "friends", "rivals", "colleagues", "romantic", "neutral", "hostile")
-    - description: your subjective description of their relationship dynamic
-    
-    Focus only on relationships where you have enough data to make an observation.
-    If there's nothing notable about some users' interactions, don't include them.
-    Include 1-to-1 relationships and also group dynamics if relevant.
-    
-    IMPORTANT: This is from your perspective as Anna - these are your personal observations about how people interact.
-    """
+    """, _RELATIONSHIP_PROMPT_SUFFIX))
     
     try:
-        response = client.models.generate_content(
-            model="gemini-2.0-flash",
-            contents=prompt,
-        )
+        response_text = _generate_text(client, prompt, RELATIONSHIPS_SCHEMA)
         
         # Process the response
         relationships_data = []
         try:
-            # Try to parse as JSON first
-            relationship_text = response.text.strip()
-            relationships_data = json.loads(relationship_text)
+            relationships_data = storage.loads(response_text)
         except json.JSONDecodeError:
-            # If not valid JSON, extract as much as we can from text
-            print(f"Error parsing relationship analysis JSON: {response.text}")
-            # Simple extraction - not ideal but better than nothing
-            if "relationship" in response.text.lower() and "user" in response.text.lower():
-                # Just save as a single relationship with description
-                relationships_data = [{
-                    "user_ids": [u["user_id"] for u in users_info],
-                    "relationship_type": "group",
-                    "description": response.text.strip()
-                }]
+            print(f"Error parsing relationship analysis JSON: {response_text}")
         
         # Save the relationship analysis
         if relationships_data:
-            global_memory.save_relationship_analysis(chat_id, relationships_data)
+            get_global_memory().save_relationship_analysis(chat_id, relationships_data)
         return relationships_data
         
     except Exception as e:
@@ -213,29 +232,45 @@ def process_pending_analyses(client, max_profiles=3, max_relationships=2):
         "relationships_processed": 0
     }
     
-    # Process user profiles
-    user_ids = global_memory.get_users_needing_profile_updates()
-    for user_id in user_ids[:max_profiles]:
-        try:
-            generate_user_profile(user_id, client)
-            results["profiles_processed"] += 1
-        except Exception as e:
-            print(f"Error processing profile for user {user_id}: {str(e)}")
+    user_ids = get_global_memory().get_users_needing_profile_updates()[:max_profiles]
+    chat_ids = get_global_memory().get_chats_needing_relationship_analysis()[:max_relationships]
+    if not user_ids and not chat_ids:
+        return results
+    
+    # Each kind of analysis is a batch of independent Gemini round-trips, so the calls of a batch
+    # run side by side. The relationship prompts include the users' personalities, so they are
+    # only started once the profiles of this pass are done, as when everything ran in sequence
+    with ThreadPoolExecutor(max_workers=max(len(user_ids), len(chat_ids))) as executor:
+        profile_futures = [(user_id, executor.submit(generate_user_profile, user_id, client))
+                           for user_id in user_ids]
+        
+        # Process user profiles
+        for user_id, future in profile_futures:
+            try:
+                future.result()
+                results["profiles_processed"] += 1
+            except Exception as e:
+                print(f"Error processing profile for user {user_id}: {str(e)}")
+        
+        relationship_futures = [(chat_id, executor.submit(generate_relationship_analysis, chat_id, client))
+                                for chat_id in chat_ids]
     
     # Process relationship analyses
-    chat_ids = global_memory.get_chats_needing_relationship_analysis()
-    for chat_id in chat_ids[:max_relationships]:
+    for chat_id, future in relationship_futures:
         try:
-            generate_relationship_analysis(chat_id, client)
+            future.result()
             results["relationships_processed"] += 1
         except Exception as e:
             print(f"Error processing relationships for chat {chat_id}: {str(e)}")
     
+    # Generated profiles and analyses are rare and costly to redo, write them out
+    # right away instead of waiting for the periodic save
+    get_global_memory().save_memory_if_dirty()
     return results
 
 def get_combined_memory_context(chat_id, user_id):
     """
     Get combined memory context including both chat-specific and global user information
     """
-    global_context = global_memory.get_global_context(chat_id, user_id)
+    global_context = get_global_memory().get_global_context(chat_id, user_id)
     return global_context 
\ No newline at end of file
@@ -1,7 +1,13 @@
+import atexit
+import hashlib
 import json
 import os
+import sys
+import threading
 from datetime import datetime
-from collections import defaultdict
+from collections import Counter
+
+import storage
 
 class GlobalMemory:
     """
@@ -17,9 +23,27 @@ class GlobalMemory:
         global_settings = self.config.get("global_memory_settings", {})
         memory_file = global_settings.get("memory_file", memory_file)
         self.memory_file = os.path.join(self.memory_dir, memory_file)
+        # Users are kept one row per user in SQLite next to the file, so a save writes only the
+        # users that changed; the file keeps chat analytics, relationships and analysis counters
+        self.users_db = os.path.splitext(self.memory_file)[0] + ".db"
+        # fdatasync every save before it is swapped in; off by default like for memory.db
+        self.durable = global_settings.get("durable_writes", False)
+        
+        # Flag to track if memory needs saving
+        self._dirty = False
+        # Hash of the last written state, a save that would write the same bytes is skipped
+        self._last_payload_hash = None
         
         # Initialize main data structures
-        self.users = {}
+        # Rows are read on first use; after a save only the users active since the previous one stay cached
+        self.users = storage.SqliteStore(self.users_db, table="users", durable=self.durable,
+                                         max_cached=global_settings.get("max_cached_users", 2048))
+        # Ids whose needs_profile_update / needs_update flag is set, so the pending lists are
+        # read without walking every user or chat. The user set is saved with the file,
+        # rebuilding it would load every user row
+        self._users_needing_profile = set()
+        self._chats_needing_analysis = set()
+        self._chats_needing_relationship_analysis = set()
         self.chat_analytics = {}
         self.relationship_analyses = {}
         self.last_analyses = {
@@ -48,8 +72,11 @@ class GlobalMemory:
         # Set max impressions from config
         self.max_impressions = global_settings.get("impression_history", {}).get("max_saved_impressions", 5)
         
-        # Flag to track if memory needs saving
-        self._dirty = False
+        # Saves come from the periodic save thread in main.py, the analysis threads and atexit
+        self._save_lock = threading.Lock()
+        # Messages only mark memory dirty, the writes are coalesced by the periodic save;
+        # write out whatever is left when the process exits
+        atexit.register(self.save_memory_if_dirty)
         
         # Print initialization info
         print(f"GlobalMemory initialized with thresholds: {self.analysis_thresholds}")
@@ -59,15 +86,37 @@ class GlobalMemory:
         """Load global memory from file if it exists and populate class attributes"""
         if os.path.exists(self.memory_file):
             try:
-                with open(self.memory_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
+                with open(self.memory_file, 'rb') as f:
+                    data = storage.loads(f.read())
                     # Load data into class attributes
-                    self.users = data.get("users", {})
+                    # Files written before the users table existed keep every user inline - move them once
+                    legacy_users = data.get("users")
+                    if legacy_users and len(self.users) == 0:
+                        for user_id, user_data in legacy_users.items():
+                            self.users[user_id] = user_data
+                        # Rewrites the file without the users on the next save
+                        self._dirty = True
+                        print(f"[GlobalMemory] Migrating users from {self.memory_file} to {self.users_db}")
                     self.chat_analytics = data.get("chat_analytics", {})
                     self.relationship_analyses = data.get("relationship_analyses", {})
                     self.last_analyses = data.get("last_analyses", {
                         "user_analysis": {}, "chat_analysis": {}, "relationship_analysis": {}
                     })
+                    users_needing_profile = data.get("users_needing_profile")
+                    if users_needing_profile is None:
+                        # Saved before the set existed - look the flags up once
+                        users_needing_profile = [user_id for user_id, user_data in self.users.items()
+                                                 if user_data.get("needs_profile_update", False)]
+                    self._users_needing_profile = set(users_needing_profile)
+                    for chat_data in self.chat_analytics.values():
+                        # Saved as a plain dict, counted with Counter.update again after loading
+                        if "topics" in chat_data:
+                            chat_data["topics"] = Counter(chat_data["topics"])
+                    self._chats_needing_analysis = {chat_id for chat_id, chat_data in self.chat_analytics.items()
+                                                    if chat_data.get("needs_update", False)}
+                    self._chats_needing_relationship_analysis = {
+                        chat_id for chat_id, relation_data in self.relationship_analyses.items()
+                        if relation_data.get("needs_update", False)}
                     print(f"[GlobalMemory] Successfully loaded data from {self.memory_file}")
                     return True # Indicate success
             except json.JSONDecodeError as e:
@@ -76,8 +125,7 @@ class GlobalMemory:
                 print(f"Error loading global memory from {self.memory_file}: {str(e)}. Starting fresh.")
         else:
             print(f"[GlobalMemory] File {self.memory_file} not found. Starting fresh.")
-        # Reset to defaults if loading failed or file not found
-        self.users = {}
+        # Reset to defaults if loading failed or file not found (users stay in their table)
         self.chat_analytics = {}
         self.relationship_analyses = {}
         self.last_analyses = {"user_analysis": {}, "chat_analysis": {}, "relationship_analysis": {}}
@@ -87,25 +135,44 @@ class GlobalMemory:
         """Save global memory to file only if changes have been made"""
         if not self._dirty:
             return False
-
+        with self._save_lock:
+            return self._save_memory_locked()
+    
+    def _save_memory_locked(self):
+        """Body of save_memory_if_dirty, runs under _save_lock"""
+        if not self._dirty:
+            return False
+        # Cleared before the snapshot so changes made while writing mark memory dirty again
+        self._dirty = False
         try:
             # Ensure the directory exists
             os.makedirs(os.path.dirname(self.memory_file), exist_ok=True)
             
+            # Only the changed user rows, in one transaction
+            users_written = self.users.flush()
+            
             data = {
-                "users": self.users,
                 "chat_analytics": self.chat_analytics,
                 "relationship_analyses": self.relationship_analyses,
                 "last_analyses": self.last_analyses,
-                "last_updated": datetime.now().isoformat()
+                "users_needing_profile": sorted(self._users_needing_profile)
             }
-            with open(self.memory_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-            # Reset dirty flag after successful save
-            self._dirty = False
+            # Compact JSON encoded in one call (orjson when installed)
+            payload = storage.dumps(data)
+            # Marked dirty but nothing actually changed since the last save - keep the file
+            payload_hash = hashlib.blake2b(payload, digest_size=16).digest()
+            if payload_hash == self._last_payload_hash:
+                return users_written > 0
+            # last_updated is left out of the hash, otherwise every save would differ.
+            # The payload is a non-empty object, so the field can be put in front of its first key
+            payload = b'{"last_updated":' + storage.dumps(datetime.now().isoformat()) + b',' + payload[1:]
+            # Written next to the file and swapped in, a crash mid-write keeps the previous version
+            storage.atomic_write(self.memory_file, payload, durable=self.durable)
+            self._last_payload_hash = payload_hash
             print(f"[GlobalMemory] Global memory saved to {self.memory_file}")
             return True
         except Exception as e:
+            self._dirty = True
             print(f"Error saving global memory: {str(e)}")
             return False
     
@@ -123,34 +190,44 @@ class GlobalMemory:
         if is_bot or not user_id:
             return False
         
-        chat_id_str = str(chat_id)
-        user_id_str = str(user_id)
+        # The id strings key users, chat_analytics, relationship_analyses and last_analyses, and the
+        # username is repeated in every active_users entry - keep one shared copy of each
+        chat_id_str = sys.intern(str(chat_id))
+        user_id_str = sys.intern(str(user_id))
+        if username:
+            username = sys.intern(username)
+        # One timestamp for everything this message updates
+        now_iso = datetime.now().isoformat()
         
-        # Create or update user in global memory
-        self._ensure_user_exists(user_id_str, username)
+        # Create or update user in global memory. The nested dicts are bound to locals once
+        # instead of being looked up again for every field below
+        user = self._ensure_user_exists(user_id_str, username, now_iso)
         
         # Record that this user participated in this chat
-        if "chats" not in self.users[user_id_str]:
-            self.users[user_id_str]["chats"] = {}
-            
-        if chat_id_str not in self.users[user_id_str]["chats"]:
-            self.users[user_id_str]["chats"][chat_id_str] = {
-                "first_seen": datetime.now().isoformat(),
+        user_chats = user.get("chats")
+        if user_chats is None:
+            user_chats = user["chats"] = {}
+        
+        user_chat = user_chats.get(chat_id_str)
+        if user_chat is None:
+            user_chat = user_chats[chat_id_str] = {
+                "first_seen": now_iso,
                 "message_count": 0
             }
         
         # Update message count for this user in this chat
-        self.users[user_id_str]["chats"][chat_id_str]["message_count"] += 1
-        self.users[user_id_str]["chats"][chat_id_str]["last_activity"] = datetime.now().isoformat()
-        self.users[user_id_str]["total_messages"] = self.users[user_id_str].get("total_messages", 0) + 1
-        self._dirty = True # Mark memory as dirty
+        user_chat["message_count"] += 1
+        user_chat["last_activity"] = now_iso
+        user_messages = user["total_messages"] = user.get("total_messages", 0) + 1
+        self._mark_user_dirty(user_id_str) # Mark the user's row as dirty
         
         # Initialize chat analytics if needed
-        if chat_id_str not in self.chat_analytics:
-            self.chat_analytics[chat_id_str] = {
+        chat_data = self.chat_analytics.get(chat_id_str)
+        if chat_data is None:
+            chat_data = self.chat_analytics[chat_id_str] = {
                 "total_messages": 0,
                 "active_users": {},
-                "topics": defaultdict(int),
+                "topics": Counter(),
                 "sentiment": {
                     "positive": 0,
                     "neutral": 0,
@@ -160,64 +237,77 @@ class GlobalMemory:
             self._dirty = True # Mark memory as dirty (new chat analytics entry)
         
         # Update chat analytics
-        self.chat_analytics[chat_id_str]["total_messages"] += 1
-        self.chat_analytics[chat_id_str]["active_users"][user_id_str] = {
-            "username": username,
-            "last_activity": datetime.now().isoformat()
-        }
+        chat_data["total_messages"] += 1
+        # Update the user's entry in place, a new dict per message only feeds the garbage collector
+        active_users = chat_data["active_users"]
+        active_user = active_users.get(user_id_str)
+        if active_user is None:
+            active_users[user_id_str] = {
+                "username": username,
+                "last_activity": now_iso
+            }
+        else:
+            active_user["username"] = username
+            active_user["last_activity"] = now_iso
         self._dirty = True # Mark memory as dirty
         
         # Check if we should perform analyses
         analyses_performed = False
         
         # User analysis (per 100 messages from this user)
-        user_messages = self.users[user_id_str]["total_messages"]
-        last_user_analysis = self.last_analyses["user_analysis"].get(user_id_str, 0)
+        last_analyses = self.last_analyses
+        last_user_analysis = last_analyses["user_analysis"].get(user_id_str, 0)
         
         if user_messages - last_user_analysis >= self.analysis_thresholds["messages_for_user_update"]:
             # Mark that we're due for analysis 
             # (actual analysis will happen in generate_user_profile())
-            self.users[user_id_str]["needs_profile_update"] = True
-            self.last_analyses["user_analysis"][user_id_str] = user_messages
+            user["needs_profile_update"] = True
+            self._users_needing_profile.add(user_id_str)
+            last_analyses["user_analysis"][user_id_str] = user_messages
             analyses_performed = True
-            self._dirty = True # Mark memory as dirty (analysis flags changed)
+            self._mark_user_dirty(user_id_str) # Analysis flag changed for this user
         
         # Chat analysis
-        chat_messages = self.chat_analytics[chat_id_str]["total_messages"]
-        last_chat_analysis = self.last_analyses["chat_analysis"].get(chat_id_str, 0)
+        chat_messages = chat_data["total_messages"]
+        last_chat_analysis = last_analyses["chat_analysis"].get(chat_id_str, 0)
         
         if chat_messages - last_chat_analysis >= self.analysis_thresholds["messages_for_chat_update"]:
             # Mark chat for analysis
             # (actual analysis will happen in generate_chat_analytics())
-            self.chat_analytics[chat_id_str]["needs_update"] = True
-            self.last_analyses["chat_analysis"][chat_id_str] = chat_messages
+            chat_data["needs_update"] = True
+            self._chats_needing_analysis.add(chat_id_str)
+            last_analyses["chat_analysis"][chat_id_str] = chat_messages
             analyses_performed = True
             self._dirty = True # Mark memory as dirty (analysis flags changed)
             
         # Relationship analysis
-        last_relationship_analysis = self.last_analyses["relationship_analysis"].get(chat_id_str, 0)
+        last_relationship_analysis = last_analyses["relationship_analysis"].get(chat_id_str, 0)
         
         if chat_messages - last_relationship_analysis >= self.analysis_thresholds["messages_for_relationship_update"]:
             # Mark for relationship analysis
             # (actual analysis will happen in generate_relationship_analysis())
-            if chat_id_str not in self.relationship_analyses:
-                self.relationship_analyses[chat_id_str] = {}
-            
-            self.relationship_analyses[chat_id_str]["needs_update"] = True
-            self.last_analyses["relationship_analysis"][chat_id_str] = chat_messages
+            self.relationship_analyses.setdefault(chat_id_str, {})["needs_update"] = True
+            self._chats_needing_relationship_analysis.add(chat_id_str)
+            last_analyses["relationship_analysis"][chat_id_str] = chat_messages
             analyses_performed = True
             self._dirty = True # Mark memory as dirty (analysis flags changed)
         
         return analyses_performed
     
-    def _ensure_user_exists(self, user_id, username):
-        """Create user entry if it doesn't exist yet"""
+    def _mark_user_dirty(self, user_id_str):
+        """Mark one user's row as changed, only changed users are written on save"""
+        self.users.mark_dirty(user_id_str)
+        self._dirty = True
+    
+    def _ensure_user_exists(self, user_id, username, now_iso=None):
+        """Create user entry if it doesn't exist yet, returns the user's data"""
+        now_iso = now_iso or datetime.now().isoformat()
         if user_id not in self.users:
-            self.users[user_id] = {
+            user_data = self.users[user_id] = {
                 "user_id": user_id,
                 "username": username,
-                "first_seen": datetime.now().isoformat(),
-                "last_seen": datetime.now().isoformat(),
+                "first_seen": now_iso,
+                "last_seen": now_iso,
                 "total_messages": 0,
                 "profile": {
                     "personality": "",
@@ -225,18 +315,19 @@ class GlobalMemory:
                     "behavior_patterns": [],
                     "relationship_with_bot": "neutral"
                 },
-                "impressions": {}  # Bot's subjective impressions about this user
+                "impressions": []  # Bot's subjective impressions about this user, oldest first
             }
             self._dirty = True # Mark memory as dirty (new user created)
         else:
+            user_data = self.users[user_id]
             # Update basic info only if username changed
-            if self.users[user_id]["username"] != username:
-                 self.users[user_id]["username"] = username # Keep username updated
-                 self._dirty = True # Mark memory as dirty
+            if user_data["username"] != username:
+                 user_data["username"] = username # Keep username updated
+                 self._mark_user_dirty(user_id) # Mark the user's row as dirty
             # Always update last_seen, but don't mark as dirty just for this
-            if self.users[user_id].get("last_seen") != datetime.now().isoformat()[:19]: # Avoid marking dirty for frequent updates
-                 self.users[user_id]["last_seen"] = datetime.now().isoformat()
-                 # Don't mark dirty just for last_seen to reduce save frequency
+            # (process_message marks the user right after anyway)
+            user_data["last_seen"] = now_iso
+        return user_data
     
     def get_user_profile(self, user_id):
         """Get the user profile from global memory"""
@@ -244,9 +335,10 @@ class GlobalMemory:
         
         if user_id_str in self.users:
             # Mark as no longer needing update if it was needed
+            self._users_needing_profile.discard(user_id_str)
             if self.users[user_id_str].get("needs_profile_update", False):
                 self.users[user_id_str]["needs_profile_update"] = False
-                self._dirty = True # Mark memory as dirty only if flag changed
+                self._mark_user_dirty(user_id_str) # Mark dirty only if flag changed
 
             return self.users[user_id_str]
         
@@ -255,13 +347,10 @@ class GlobalMemory:
     def get_chat_users(self, chat_id):
         """Get all users who have participated in a chat"""
         chat_id_str = str(chat_id)
-        users_in_chat = {}
-        
-        for user_id, user_data in self.users.items():
-            if "chats" in user_data and chat_id_str in user_data["chats"]:
-                users_in_chat[user_id] = user_data
-                
-        return users_in_chat
+        # process_message records every user of a chat in its active_users together with the
+        # user's own "chats" entry, so that map is the chat -> users index
+        active_users = self.chat_analytics.get(chat_id_str, {}).get("active_users", {})
+        return {user_id: self.users[user_id] for user_id in active_users if user_id in self.users}
     
     def save_user_profile(self, user_id, profile_data):
         """
@@ -278,9 +367,10 @@ class GlobalMemory:
         
         # Mark as no longer needing update
         self.users[user_id_str]["needs_profile_update"] = False
+        self._users_needing_profile.discard(user_id_str)
         
         # Save changes
-        self._dirty = True # Mark memory as dirty
+        self._mark_user_dirty(user_id_str) # Mark the user's row as dirty
         return True
     
     def save_user_impression(self, user_id, impression):
@@ -296,33 +386,44 @@ class GlobalMemory:
         # Add recent impression with timestamp
         current_time = datetime.now().isoformat()
         
-        # Initialize impressions dict if it doesn't exist
-        if "impressions" not in self.users[user_id_str]:
-            self.users[user_id_str]["impressions"] = {}
-            
-        self.users[user_id_str]["impressions"][current_time] = impression
+        impressions = self._impression_list(self.users[user_id_str])
+        impressions.append({"ts": current_time, "text": impression})
         
-        # Keep only the most recent impressions based on config
-        if len(self.users[user_id_str]["impressions"]) > self.max_impressions:
-            # Sort by timestamp and remove oldest
-            sorted_impressions = sorted(self.users[user_id_str]["impressions"].items())
-            oldest_timestamp = sorted_impressions[0][0]
-            del self.users[user_id_str]["impressions"][oldest_timestamp]
+        # Keep only the most recent impressions based on config. The list is in
+        # chronological order, so the oldest ones are at the front
+        if len(impressions) > self.max_impressions:
+            del impressions[:len(impressions) - self.max_impressions]
         
         # Save changes
-        self._dirty = True # Mark memory as dirty
+        self._mark_user_dirty(user_id_str) # Mark the user's row as dirty
         return True
     
+    @staticmethod
+    def _impression_list(user_data):
+        """
+        The user's impressions as a list of {"ts", "text"} records, oldest first.
+        Rows saved before impressions became a list keep them as a {timestamp: text} dict,
+        those are converted in place on first use
+        """
+        impressions = user_data.get("impressions")
+        if isinstance(impressions, dict):
+            impressions = [{"ts": ts, "text": text} for ts, text in sorted(impressions.items())]
+            user_data["impressions"] = impressions
+        elif impressions is None:
+            impressions = []
+            user_data["impressions"] = impressions
+        return impressions
+    
     def get_user_impressions(self, user_id):
         """
-        Get the history of impressions about a user
+        Get the history of impressions about a user as {"ts", "text"} records, oldest first
         """
         user_id_str = str(user_id)
         
-        if user_id_str in self.users and "impressions" in self.users[user_id_str]:
-            return self.users[user_id_str]["impressions"]
+        if user_id_str in self.users:
+            return self._impression_list(self.users[user_id_str])
         
-        return {}
+        return []
     
     def get_latest_user_impression(self, user_id):
         """
@@ -330,12 +431,11 @@ class GlobalMemory:
         """
         user_id_str = str(user_id)
         
-        if user_id_str in self.users and "impressions" in self.users[user_id_str]:
-            impressions = self.users[user_id_str]["impressions"]
+        if user_id_str in self.users:
+            impressions = self._impression_list(self.users[user_id_str])
             if impressions:
-                # Get the latest impression
-                latest_timestamp = max(impressions.keys())
-                return impressions[latest_timestamp]
+                # The list is chronological, the latest impression is the last one
+                return impressions[-1]["text"]
         
         return ""
     
@@ -355,6 +455,7 @@ class GlobalMemory:
         
         # Mark as no longer needing update
         self.relationship_analyses[chat_id_str]["needs_update"] = False
+        self._chats_needing_relationship_analysis.discard(chat_id_str)
         
         # Save changes
         self._dirty = True # Mark memory as dirty
@@ -375,37 +476,19 @@ class GlobalMemory:
         """
         Return a list of user_ids that need profile updates
         """
-        needs_update = []
-        
-        for user_id, user_data in self.users.items():
-            if user_data.get("needs_profile_update", False):
-                needs_update.append(user_id)
-        
-        return needs_update
+        return list(self._users_needing_profile)
     
     def get_chats_needing_analysis(self):
         """
         Return a list of chat_ids that need chat analysis
         """
-        needs_update = []
-        
-        for chat_id, chat_data in self.chat_analytics.items():
-            if chat_data.get("needs_update", False):
-                needs_update.append(chat_id)
-        
-        return needs_update
+        return list(self._chats_needing_analysis)
     
     def get_chats_needing_relationship_analysis(self):
         """
         Return a list of chat_ids that need relationship analysis
         """
-        needs_update = []
-        
-        for chat_id, relation_data in self.relationship_analyses.items():
-            if relation_data.get("needs_update", False):
-                needs_update.append(chat_id)
-        
-        return needs_update
+        return list(self._chats_needing_relationship_analysis)
     
     def update_thresholds(self, thresholds_dict):
         """
@@ -425,47 +508,50 @@ class GlobalMemory:
         """
         user_id_str = str(user_id)
         chat_id_str = str(chat_id)
-        context = "Global memory information:\n\n"
+        # Collected as parts and joined once at the end
+        parts = ["Global memory information:\n\n"]
+        append = parts.append
         
         # Add user profile if available
         if user_id_str in self.users:
             user_data = self.users[user_id_str]
             username = user_data.get("username", "Unknown")
             
-            context += f"User information for {username} (ID: {user_id_str}):\n"
+            append(f"User information for {username} (ID: {user_id_str}):\n")
             
             # Add profile data
-            profile = user_data.get("profile", {})
-            if profile and profile.get("personality"):
-                context += f"Personality: {profile.get('personality', '')}\n"
+            profile = user_data.get("profile") or {}
+            personality = profile.get("personality")
+            if personality:
+                append(f"Personality: {personality}\n")
             
-            if profile and profile.get("interests"):
-                context += "Interests: " + ", ".join(profile.get("interests", [])) + "\n"
+            interests = profile.get("interests")
+            if interests:
+                append(f"Interests: {', '.join(interests)}\n")
             
-            if profile and profile.get("behavior_patterns"):
-                context += "Behavior patterns: " + ", ".join(profile.get("behavior_patterns", [])) + "\n"
+            behavior_patterns = profile.get("behavior_patterns")
+            if behavior_patterns:
+                append(f"Behavior patterns: {', '.join(behavior_patterns)}\n")
             
-            if profile and profile.get("relationship_with_bot"):
-                context += f"My relationship with this user: {profile.get('relationship_with_bot', 'neutral')}\n"
+            relationship_with_bot = profile.get("relationship_with_bot")
+            if relationship_with_bot:
+                append(f"My relationship with this user: {relationship_with_bot}\n")
             
             # Add most recent impression
             latest_impression = self.get_latest_user_impression(user_id_str)
             if latest_impression:
-                context += f"\nMy impression of this user: {latest_impression}\n"
+                append(f"\nMy impression of this user: {latest_impression}\n")
         
         # Add relationship data for the current chat
-        if chat_id_str in self.relationship_analyses and "relationships" in self.relationship_analyses[chat_id_str]:
-            relationship_data = self.relationship_analyses[chat_id_str]["relationships"]
-            
+        relationship_data = self.relationship_analyses.get(chat_id_str, {}).get("relationships")
+        if relationship_data:
             # Check if the current user is mentioned in any relationships
-            user_relationships = []
-            for relation in relationship_data:
-                if user_id_str in relation.get("user_ids", []):
-                    user_relationships.append(relation)
+            user_relationships = [relation for relation in relationship_data
+                                  if user_id_str in relation.get("user_ids", [])]
             
             if user_relationships:
-                context += "\nUser relationships in this chat:\n"
+                append("\nUser relationships in this chat:\n")
                 for relation in user_relationships:
-                    context += f"- {relation.get('description', '')}\n"
+                    append(f"- {relation.get('description', '')}\n")
         
-        return context 
\ No newline at end of file
+        return "".join(parts)
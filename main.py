@@ -1,7 +1,10 @@
 import os
+import hashlib
 import json
+import logging
 import re
 import requests
+from requests.adapters import HTTPAdapter
 import random
 import threading
 from flask import Flask, request, jsonify
@@ -11,10 +14,16 @@ from context_manager import ContextManager
 from scheduled_messages import ScheduledMessenger
 from context_caching import ContextCache
 from global_memory import GlobalMemory
+import storage
 import global_analysis
+from triggers import build_should_respond, build_substring_matcher
 import time
 from datetime import datetime, timedelta
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+# Modules like context_manager log through logging; print them like the rest of the server output
+logging.basicConfig(level=logging.INFO, format="[%(name)s] %(message)s")
 
 app = Flask(__name__)
 
@@ -22,6 +31,14 @@ app = Flask(__name__)
 TELEGRAM_BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN')
 GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
 
+# One session for all Telegram API calls, so the TCP and TLS connection to api.telegram.org
+# is kept alive between messages instead of being set up again for every request
+TELEGRAM_SESSION = requests.Session()
+TELEGRAM_SESSION.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=100))
+TELEGRAM_TIMEOUT_SECONDS = 10
+TELEGRAM_API_URL = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/"
+JSON_HEADERS = {"Content-Type": "application/json"}
+
 # Використовуємо напряму шлях до диску
 MEMORY_PATH = '/memory/memory.json'
 GLOBAL_MEMORY_PATH = '/memory/global_memory.json' # Define path for global memory
@@ -40,6 +57,12 @@ except Exception as e:
     TOKEN_USAGE_FILE = 'token_usage.json'
     print("[SERVER LOG] Fallback to local storage")
 
+# JSON object embedded in a Gemini reply, compiled once instead of on every analysis
+JSON_OBJECT_PATTERN = re.compile(r'\{.*\}', re.DOTALL)
+
+# Seconds to wait for more messages of a batch, load_config sets it from message_batching.timeout_seconds
+MESSAGE_BATCH_TIMEOUT = 2
+
 # Load configuration
 def load_config():
     global message_batches, MESSAGE_BATCH_TIMEOUT
@@ -85,11 +108,14 @@ group_settings = CONFIG.get("group_chat_settings", {})
 context_manager = ContextManager(
     max_messages=context_settings.get("max_messages", 200),
     memory_file=MEMORY_PATH,
-    session_timeout_seconds=group_settings.get("session_timeout_seconds", 300)
+    session_timeout_seconds=group_settings.get("session_timeout_seconds", 300),
+    durable=context_settings.get("durable_writes", False)
 )
 
 # Initialize global memory
 global_memory = GlobalMemory(config=CONFIG, memory_file=GLOBAL_MEMORY_PATH)
+# The analyses must work on the same instance: two instances would overwrite each other's file
+global_analysis.set_global_memory(global_memory)
 
 # Initialize context cache
 context_cache = ContextCache(context_manager, CONFIG)
@@ -101,18 +127,17 @@ if scheduled_messages_config.get("enabled", False):
         telegram_token=TELEGRAM_BOT_TOKEN,
         gemini_api_key=GEMINI_API_KEY,
         memory_file=MEMORY_PATH,
-        config_file="config.json"
+        config_file="config.json",
+        config=CONFIG,
+        context_manager=context_manager,
+        http_session=TELEGRAM_SESSION
     )
     
     # Override settings from config if specified
-    if "min_hours_between_messages" in scheduled_messages_config:
-        scheduled_messenger.min_hours_between_messages = scheduled_messages_config["min_hours_between_messages"]
-    if "max_hours_between_messages" in scheduled_messages_config:
-        scheduled_messenger.max_hours_between_messages = scheduled_messages_config["max_hours_between_messages"]
-    if "max_messages_per_day" in scheduled_messages_config:
-        scheduled_messenger.max_messages_per_day = scheduled_messages_config["max_messages_per_day"]
-    if "active_session_cooldown_minutes" in scheduled_messages_config:
-        scheduled_messenger.active_session_cooldown_minutes = scheduled_messages_config["active_session_cooldown_minutes"]
+    for setting in ("min_hours_between_messages", "max_hours_between_messages",
+                    "max_messages_per_day", "active_session_cooldown_minutes"):
+        if setting in scheduled_messages_config:
+            setattr(scheduled_messenger, setting, scheduled_messages_config[setting])
     
     # Start the scheduler
     check_interval = scheduled_messages_config.get("check_interval_minutes", 15)
@@ -127,9 +152,113 @@ client = genai.Client(
     api_key=GEMINI_API_KEY
 )
 
+# Replies are generated off the request thread, so the webhook answers Telegram right away
+# instead of waiting for the Gemini round-trip (a slow answer makes Telegram resend the update)
+RESPONSE_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix="response")
+
+# PERSONALITY goes to Gemini as the system instruction of the persona prompts instead of being
+# glued in front of every prompt string, so the invariant part of the request is kept apart
+# from the per-message contents and the prompt strings stay small
+PERSONA_CONFIG = {"system_instruction": PERSONALITY}
+
+# Gemini context caching for the stable part of the reply prompt: the personality and the memory
+# context, which only change when something is remembered. Off by default - cached content is billed
+# per hour of storage, and Gemini rejects prefixes below a minimum size, those are sent inline as before
+PROMPT_CACHING = CONFIG.get("context_settings", {}).get("prompt_caching", {})
+PROMPT_CACHING_ENABLED = PROMPT_CACHING.get("enabled", False)
+# Explicit caches need a fixed model version
+PROMPT_CACHE_MODEL = PROMPT_CACHING.get("model", "gemini-2.0-flash-001")
+PROMPT_CACHE_TTL_SECONDS = PROMPT_CACHING.get("ttl_seconds", 3600)
+MAX_PROMPT_CACHES = PROMPT_CACHING.get("max_caches", 32)
+# Hash of the cached text -> (cache name, or None if Gemini refused it, expiry time)
+_prompt_caches = {}
+_prompt_caches_lock = threading.Lock()
+
+def get_prompt_cache(prefix):
+    """
+    Return the name of a Gemini cache holding PERSONALITY and prefix, creating it when needed.
+    None means the prefix has to be sent with the request
+    """
+    if not PROMPT_CACHING_ENABLED or not prefix:
+        return None
+    key = hashlib.blake2b(prefix.encode("utf-8"), digest_size=16).digest()
+    now = time.time()
+    with _prompt_caches_lock:
+        entry = _prompt_caches.pop(key, None)
+        # A minute of margin so the cache does not expire while the request is running
+        if entry is not None and entry[1] - 60 > now:
+            _prompt_caches[key] = entry
+            return entry[0]
+    
+    cache_name = None
+    try:
+        cache = client.caches.create(model=PROMPT_CACHE_MODEL, config={
+            "system_instruction": PERSONALITY,
+            "contents": [prefix],
+            "ttl": f"{PROMPT_CACHE_TTL_SECONDS}s",
+        })
+        cache_name = cache.name
+    except Exception as e:
+        # Usually a prefix below the minimum size; remembered, so it is not retried on every message
+        print(f"[SERVER LOG] Prompt cache not created, sending the prefix inline: {str(e)}")
+    
+    evicted = []
+    with _prompt_caches_lock:
+        _prompt_caches[key] = (cache_name, now + PROMPT_CACHE_TTL_SECONDS)
+        while len(_prompt_caches) > MAX_PROMPT_CACHES:
+            evicted.append(_prompt_caches.pop(next(iter(_prompt_caches)))[0])
+    # Don't keep paying for caches that will not be used again
+    for name in evicted:
+        if name:
+            try:
+                client.caches.delete(name=name)
+            except Exception as e:
+                print(f"[SERVER LOG] Error deleting prompt cache {name}: {str(e)}")
+    return cache_name
+
 # Message batching system to handle multiple messages at once (for forwarded messages etc.)
 message_batches = {}
-MESSAGE_BATCH_TIMEOUT = 2  # seconds to wait for more messages
+# Batches are filled by webhook requests and answered from timer threads
+message_batches_lock = threading.Lock()
+# A batch is answered right away once it holds this many messages
+MAX_BATCH_MESSAGES = 8
+
+def schedule_batch_flush(batch_key, delay):
+    """Answer the batch after delay seconds, see flush_message_batch"""
+    timer = threading.Timer(delay, flush_message_batch, args=(batch_key,))
+    timer.daemon = True
+    timer.start()
+
+def flush_message_batch(batch_key):
+    """
+    Answer a message batch with one Gemini call once no new message was added for
+    MESSAGE_BATCH_TIMEOUT seconds. A batch that is still growing is checked again later
+    """
+    with message_batches_lock:
+        batch = message_batches.get(batch_key)
+        if batch is None:
+            return
+        quiet_for = time.time() - batch['last_update']
+        if quiet_for < MESSAGE_BATCH_TIMEOUT and len(batch['messages']) < MAX_BATCH_MESSAGES:
+            # More messages arrived meanwhile - wait until the user pauses
+            schedule_batch_flush(batch_key, MESSAGE_BATCH_TIMEOUT - quiet_for)
+            return
+        # Clean up the batch
+        del message_batches[batch_key]
+
+    batched_messages = batch['messages']
+    is_group = batch['is_group']
+    # Use the ID of the *first* message in the batch for potential reply (only in groups)
+    reply_id = batch['message_ids'][0] if is_group else None
+
+    # If we have multiple messages, combine them for a single response
+    if len(batched_messages) > 1:
+        prompt = "Користувач надіслав кілька повідомлень:\n\n" + "\n".join([f"- {msg}" for msg in batched_messages])
+    else:
+        prompt = batched_messages[0]
+    # Generated on the response workers like every other reply, not on the timer thread
+    RESPONSE_EXECUTOR.submit(send_generated_response, batch['chat_id'], prompt,
+                             batch['user_id'], batch['username'], reply_id, is_group)
 
 # Track token usage
 token_usage = {
@@ -144,8 +273,8 @@ token_usage = {
 def save_token_usage():
     """Save token usage statistics to a file"""
     try:
-        with open(TOKEN_USAGE_FILE, 'w', encoding='utf-8') as f:
-            json.dump(token_usage, f, ensure_ascii=False, indent=2)
+        # Encoded in one call and written with a single write(), see storage.atomic_write
+        storage.atomic_write(TOKEN_USAGE_FILE, storage.dumps(token_usage))
         print(f"[SERVER LOG] Token usage saved to {TOKEN_USAGE_FILE}")
     except Exception as e:
         print(f"[SERVER LOG] Error saving token usage: {str(e)}")
@@ -155,8 +284,8 @@ def load_token_usage():
     global token_usage
     try:
         if os.path.exists(TOKEN_USAGE_FILE):
-            with open(TOKEN_USAGE_FILE, 'r', encoding='utf-8') as f:
-                loaded_usage = json.load(f)
+            with open(TOKEN_USAGE_FILE, 'rb') as f:
+                loaded_usage = storage.loads(f.read())
                 # Update with loaded values but keep current last_check_time
                 for key, value in loaded_usage.items():
                     if key != "last_check_time":
@@ -227,9 +356,15 @@ def check_token_usage():
         # Save token usage stats to file
         save_token_usage()
 
+def telegram_request(method, payload):
+    """Call a Telegram Bot API method over the shared session and return the parsed reply"""
+    url = TELEGRAM_API_URL + method
+    response = TELEGRAM_SESSION.post(url, data=storage.dumps(payload), headers=JSON_HEADERS,
+                                     timeout=TELEGRAM_TIMEOUT_SECONDS)
+    return storage.loads(response.content)
+
 def send_message(chat_id, text, reply_to_message_id=None):
     """Send message to Telegram chat"""
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
     payload = {
         "chat_id": chat_id,
         "text": text,
@@ -239,20 +374,18 @@ def send_message(chat_id, text, reply_to_message_id=None):
     if reply_to_message_id:
         payload["reply_to_message_id"] = reply_to_message_id
         
-    response = requests.post(url, json=payload)
-    return response.json()
+    return telegram_request("sendMessage", payload)
 
 def send_typing_action(chat_id, message_text=None):
     """
     Send typing action to Telegram chat to show 'Анна печатает...'
     If message_text is provided, simulates typing time based on message length
     """
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendChatAction"
     payload = {
         "chat_id": chat_id,
         "action": "typing"
     }
-    response = requests.post(url, json=payload)
+    result = telegram_request("sendChatAction", payload)
     
     # If message text is provided, calculate typing duration
     # REMOVED sleep based on calculation
@@ -261,14 +394,12 @@ def send_typing_action(chat_id, message_text=None):
     #     typing_seconds = min(max(len(message_text) * 0.03, 1), 7)
     #     # time.sleep(typing_seconds) # Removed sleep for performance
 
-    return response.json()
+    return result
 
 def generate_user_impression(username, message_count, message_sample, existing_impression=""):
     """Generate a personality-infused impression of a user based on their messages"""
-    # Build a prompt that includes the bot's personality and the user's messages
-    prompt = PERSONALITY + "\n\n"
-    
-    prompt += f"""
+    # Build a prompt with the user's messages, the bot's personality is the system instruction
+    prompt = f"""
 Зараз тобі потрібно сформувати враження про користувача {username} на основі їхніх повідомлень.
 У тебе є {message_count} повідомлень від цього користувача, але я покажу тобі лише останні 50 (або менше).
 
@@ -291,13 +422,14 @@ def generate_user_impression(username, message_count, message_sample, existing_i
     prompt += "Напиши своє оновлене враження про цю людину з твоєї перспективи, враховуючи те, що ти знаєш про неї. Опиши, як ти її сприймаєш:"
     
     # Log input tokens for impression generation
-    input_tokens = log_token_usage(prompt, "input")
+    input_tokens = log_token_usage(PERSONALITY + prompt, "input")
     print(f"[SERVER LOG] Impression request tokens: {input_tokens}")
     
     try:
         response = client.models.generate_content(
             model="gemini-2.0-flash",
             contents=prompt,
+            config=PERSONA_CONFIG,
         )
         impression = response.text.strip()
         
@@ -387,12 +519,8 @@ def get_memory_context(chat_id, user_id=None):
     if user_impressions:
         memory_context += "\nMy impressions of people in this chat:\n"
         for u_id, impression in user_impressions.items():
-            username = "Unknown"
-            # Try to find the username from conversation history
-            for msg in context_manager.conversations.get(str(chat_id), []):
-                if str(msg.get("user_id", "")) == u_id and msg.get("username"):
-                    username = msg["username"]
-                    break
+            # Username from the per-user index of the conversation history
+            username = context_manager.get_username(chat_id, u_id)
                     
             memory_context += f"- {username}: {impression}\n"
     
@@ -406,26 +534,24 @@ def get_memory_context(chat_id, user_id=None):
 
 def generate_response(user_input, chat_id, user_id=None, username=None):
     """Generate a response using Gemini API"""
-    # Get conversation history
-    conversation_history = context_manager.get_conversation_context(chat_id)
+    # Get the rolling summary and the messages it does not cover yet
+    conversation_summary, conversation_history = context_cache.get_context_for_prompt(chat_id)
     
     # Get memory context (including global user context if user_id is provided)
     memory_context = get_memory_context(chat_id, user_id)
     
-    # Get summary if available
-    conversation_summary = context_cache.get_conversation_summary(chat_id)
-    
-    # Build the prompt
-    prompt = f"{PERSONALITY}\n\n"
+    # Build the prompt, the personality is sent as the system instruction
+    prompt = ""
     
     if memory_context:
         prompt += f"[Memory Context]\n{memory_context}\n\n"
+    # Everything before this point can be served from a Gemini cache, see get_prompt_cache
+    prefix_length = len(prompt)
     
     if conversation_summary:
         prompt += f"[Conversation Summary]\n{conversation_summary}\n\n"
-        # If we have a summary, we can use a shorter conversation history (last 10 messages)
-        short_history = "\n".join(conversation_history.split("\n")[-20:]) if conversation_history else ""
-        prompt += f"[Recent Messages]\n{short_history}\n\n"
+        # Older messages are in the summary, only the recent ones are sent verbatim
+        prompt += f"[Recent Messages]\n{conversation_history}\n\n"
         log_token_usage(prompt, "summarized")
     else:
         # Otherwise use the full conversation history
@@ -434,15 +560,29 @@ def generate_response(user_input, chat_id, user_id=None, username=None):
     
     prompt += f"User message:\n{user_input}"
     
-    # Log estimated token usage for input
-    log_token_usage(prompt, "input")
+    # Log estimated token usage for input (the system instruction is billed as input too)
+    log_token_usage(PERSONALITY + prompt, "input")
     
     # Generate the response with Gemini
     try:
-        response = client.models.generate_content(
-            model="gemini-2.0-flash",
-            contents=prompt,
-        )
+        response = None
+        cache_name = get_prompt_cache(prompt[:prefix_length])
+        if cache_name:
+            try:
+                # Personality and memory context come from the cache, only the conversation is sent
+                response = client.models.generate_content(
+                    model=PROMPT_CACHE_MODEL,
+                    contents=prompt[prefix_length:],
+                    config={"cached_content": cache_name},
+                )
+            except Exception as e:
+                print(f"[SERVER LOG] Cached prompt failed, sending it inline: {str(e)}")
+        if response is None:
+            response = client.models.generate_content(
+                model="gemini-2.0-flash",
+                contents=prompt,
+                config=PERSONA_CONFIG,
+            )
         
         # Log estimated token usage for output
         log_token_usage(response.text, "output")
@@ -453,98 +593,16 @@ def generate_response(user_input, chat_id, user_id=None, username=None):
         print(f"Error generating response: {str(e)}")
         return "вибач, щось пішло не так. спробуй ще раз через хвилину"
 
-def should_respond(text):
-    """Check if the message contains keywords that should trigger a response"""
-    # Always respond to direct messages if enabled
-    if CONFIG["response_settings"]["respond_to_direct_messages"] and text.startswith('/'):
-        return True
-    
-    # Check for keywords
-    if not CONFIG["trigger_detection"]["enabled"]:
-        return False
-    
-    # Prepare text for comparison
-    check_text = text
-    if not CONFIG["trigger_detection"]["case_sensitive"]:
-        check_text = text.lower()
-        keywords = [k.lower() for k in CONFIG["keywords"]]
-        ignored_phrases = [p.lower() for p in CONFIG["trigger_detection"].get("ignored_phrases", [])]
-    else:
-        keywords = CONFIG["keywords"]
-        ignored_phrases = CONFIG["trigger_detection"].get("ignored_phrases", [])
-    
-    # Check for ignored phrases
-    for phrase in ignored_phrases:
-        if phrase in check_text.lower():
-            return False
-    
-    # Check if message should be at the beginning
-    must_be_at_beginning = CONFIG["trigger_detection"].get("must_be_at_beginning", False)
-    
-    # Pre-process text to handle messages without spaces
-    # Replace common punctuation with spaces to better isolate words
-    import string
-    for punct in string.punctuation:
-        check_text = check_text.replace(punct, ' ')
-    
-    # Handle common cases when people write without spaces
-    # This will help detect keywords even if written without proper spacing
-    words_to_check = [check_text]  # Original text
-    
-    # Add first word of the message for checking
-    first_word = check_text.split()[0] if check_text.split() else ""
-    if first_word:
-        words_to_check.append(first_word)
-    
-    # Check each keyword
-    for keyword in keywords:
-        if CONFIG["trigger_detection"]["whole_word_only"]:
-            # Use regex to check for whole word match with word boundaries
-            pattern = r'\b' + re.escape(keyword) + r'\b'
-            
-            if must_be_at_beginning:
-                # Check if keyword is at the beginning of the message
-                pattern = r'^\s*' + pattern
-            
-            # Try to match on original text
-            if re.search(pattern, check_text):
-                return True
-                
-            # Also check for the keyword at the beginning without proper spacing
-            # This helps with cases like "Аняпривіт" or "Анякдела"
-            if re.search(r'^' + re.escape(keyword), check_text.replace(' ', '')):
-                return True
-        else:
-            # Check for substring match
-            if must_be_at_beginning:
-                # Check if keyword is at the beginning of the message
-                words = check_text.split()
-                if words and keyword in words[0]:
-                    return True
-            else:
-                if keyword in check_text:
-                    return True
-                
-                # Check if the keyword is at the beginning without proper spacing
-                if check_text.replace(' ', '').startswith(keyword):
-                    return True
-    
-    return False
+# Trigger settings are fixed while the bot runs, see triggers.build_should_respond
+should_respond = build_should_respond(CONFIG)
+
+# End-session commands lowercased once and checked in one pass, like the trigger keywords
+contains_session_end_command = build_substring_matcher(
+    cmd.lower() for cmd in CONFIG.get("group_chat_settings", {}).get("end_session_commands", []))
 
 def is_session_end_command(text):
     """Check if the message is a command to end the session"""
-    end_commands = CONFIG.get("group_chat_settings", {}).get("end_session_commands", [])
-    
-    if not end_commands:
-        return False
-    
-    text_lower = text.lower()
-    
-    for cmd in end_commands:
-        if cmd.lower() in text_lower:
-            return True
-    
-    return False
+    return contains_session_end_command(text.lower())
 
 def handle_memory_command(chat_id, command_text):
     """Handle memory management commands"""
@@ -595,12 +653,8 @@ def handle_memory_command(chat_id, command_text):
         response = "💭 *Ось що я думаю про людей в цьому чаті:*\n\n"
         
         for user_id, impression in user_impressions.items():
-            username = "Unknown"
-            # Try to find the username from conversation history
-            for msg in context_manager.conversations.get(str(chat_id), []):
-                if str(msg.get("user_id", "")) == user_id and msg.get("username"):
-                    username = msg["username"]
-                    break
+            # Username from the per-user index of the conversation history
+            username = context_manager.get_username(chat_id, user_id)
                     
             response += f"*{username}:* {impression}\n\n"
         
@@ -713,17 +767,30 @@ def handle_schedule_command(chat_id, command_text):
         return f"❌ Шо за '{action}'? Не знаю такого. Спробуй status, on або off"
 
 def generate_conversation_summary(chat_id):
-    """Generates a concise summary of the recent conversation"""
+    """Merges the messages that fell out of the recent window into the rolling summary"""
     
-    # Get the conversation context
-    messages = context_manager.get_conversation_context(chat_id)
+    summary_input = context_cache.get_summary_input(chat_id)
+    if summary_input is None:
+        return None
+    previous_summary, messages, covers_up_to = summary_input
     
-    # Limit input length
-    if len(messages) > 1000:  # Approximately 1000 tokens
-        messages = messages[-1000:]
+    if previous_summary:
+        summary_prompt = f"""
+    Update the conversation summary below with the new messages.
+    Keep it brief (3-5 sentences, at most {context_cache.max_summary_tokens} tokens)
+    and capture the main topics, mood, and key points. Drop details that no longer matter.
+    This summary will be used as context for future interactions.
     
-    summary_prompt = f"""
-    Read the recent conversation and create a brief summary (3-5 sentences)
+    Current summary:
+    {previous_summary}
+    
+    New messages:
+    {messages}
+    """
+    else:
+        summary_prompt = f"""
+    Read the recent conversation and create a brief summary (3-5 sentences,
+    at most {context_cache.max_summary_tokens} tokens)
     that captures the main topics, mood, and key points.
     This summary will be used as context for future interactions.
     
@@ -748,7 +815,7 @@ def generate_conversation_summary(chat_id):
         print(f"[SERVER LOG] Summary response tokens: {output_tokens}")
         
         # Save the summary to memory
-        context_cache.save_conversation_summary(chat_id, summary)
+        context_cache.save_conversation_summary(chat_id, summary, covers_up_to)
         
         return summary
     except Exception as e:
@@ -821,12 +888,12 @@ def handle_global_memory_command(chat_id, command_text):
                 response += f"*Відносини зі мною:* {profile['relationship_with_bot']}\n\n"
         
         # Add impressions
-        impressions = found_user.get("impressions", {})
+        impressions = global_memory.get_user_impressions(user_id)
         if impressions:
             response += "*Мої враження:*\n"
-            for timestamp, impression in sorted(impressions.items(), reverse=True)[:3]:
-                date = timestamp.split("T")[0]
-                response += f"- [{date}] {impression}\n"
+            for record in reversed(impressions[-3:]):
+                date = record["ts"].split("T")[0]
+                response += f"- [{date}] {record['text']}\n"
         
         # Add active chats
         chats = found_user.get("chats", {})
@@ -877,8 +944,6 @@ def should_send_followup_message(chat_id, user_id, previous_response):
 
     # Analyze last few exchanges
     prompt = f"""
-    {PERSONALITY}
-
     Тобі треба вирішити, чи варто мені надіслати *додаткове*, коротке повідомлення *після* моєї попередньої відповіді. **Будь більш схильною до надсилання**, якщо це допоможе розмові бути більш живою та в моєму стилі.
 
     Нещодавня розмова:
@@ -907,23 +972,20 @@ def should_send_followup_message(chat_id, user_id, previous_response):
     """
 
     # Log token usage for analysis request
-    log_token_usage(prompt, "input")
+    log_token_usage(PERSONALITY + prompt, "input")
 
     try:
         response = client.models.generate_content(
             model="gemini-2.0-flash",
             contents=prompt,
+            config=PERSONA_CONFIG,
         )
 
         # Log token usage for analysis response
         log_token_usage(response.text, "output")
 
-        # Extract JSON from response
-        import json
-        import re
-
         # Find JSON pattern in the response
-        json_match = re.search(r'\{.*\}', response.text, re.DOTALL)
+        json_match = JSON_OBJECT_PATTERN.search(response.text)
         if json_match:
             analysis = json.loads(json_match.group(0))
             print(f"[SERVER LOG] Follow-up Analysis: {analysis}") # Log analysis result
@@ -944,9 +1006,7 @@ def generate_followup_message(chat_id, user_id, username, previous_response):
     memory_context = get_memory_context(chat_id, user_id)
     
     # Build prompt for follow-up generation
-    prompt = f"""{PERSONALITY}
-
-{memory_context}
+    prompt = f"""{memory_context}
 
 Нещодавня розмова:
 {conversation}
@@ -958,12 +1018,13 @@ def generate_followup_message(chat_id, user_id, username, previous_response):
 Моє додаткове повідомлення:"""
 
     # Log token usage
-    log_token_usage(prompt, "input")
+    log_token_usage(PERSONALITY + prompt, "input")
     
     try:
         response = client.models.generate_content(
             model="gemini-2.0-flash",
             contents=prompt,
+            config=PERSONA_CONFIG,
         )
         
         followup = response.text.strip()
@@ -1066,6 +1127,61 @@ def process_followup_queue():
     return len(keys_to_remove)
 
 # Function to run background tasks in a separate thread
+# Held while run_background_tasks runs. Every webhook asks for a run; while one is in progress the
+# request is dropped, so bursts don't start a thread per update that repeats the same Gemini work
+background_tasks_lock = threading.Lock()
+# Busy groups send updates every second, mostly messages the bot ignores. The pending work (follow-ups,
+# impressions, analyses, summaries) is measured in minutes, so a pass is started at most this often
+BACKGROUND_TASKS_MIN_INTERVAL_SECONDS = 10
+last_background_tasks_start = 0.0
+# Trailing pass armed when a request is throttled or a pass is still running. Passes are only asked
+# for by webhooks, so without it the work queued by the last updates of a burst would wait for the
+# next Telegram update, possibly hours later
+background_tasks_timer = None
+background_tasks_timer_lock = threading.Lock()
+
+def _arm_background_tasks_timer(delay):
+    """Start a pass after delay seconds unless one is already scheduled"""
+    global background_tasks_timer
+    with background_tasks_timer_lock:
+        if background_tasks_timer is not None:
+            return
+        background_tasks_timer = threading.Timer(delay, _run_scheduled_background_tasks)
+        background_tasks_timer.daemon = True
+        background_tasks_timer.start()
+
+def _run_scheduled_background_tasks():
+    global background_tasks_timer
+    with background_tasks_timer_lock:
+        background_tasks_timer = None
+    start_background_tasks()
+
+def start_background_tasks():
+    """
+    Run the background tasks in a new thread unless a run is in progress or has just been started.
+    A skipped request is retried once the interval is over
+    """
+    global last_background_tasks_start
+    remaining = BACKGROUND_TASKS_MIN_INTERVAL_SECONDS - (time.monotonic() - last_background_tasks_start)
+    if remaining > 0:
+        _arm_background_tasks_timer(remaining)
+        return False
+    if not background_tasks_lock.acquire(blocking=False):
+        _arm_background_tasks_timer(BACKGROUND_TASKS_MIN_INTERVAL_SECONDS)
+        return False
+    last_background_tasks_start = time.monotonic()
+    def run():
+        try:
+            run_background_tasks()
+        finally:
+            background_tasks_lock.release()
+    try:
+        threading.Thread(target=run).start()
+    except Exception:
+        background_tasks_lock.release()
+        raise
+    return True
+
 def run_background_tasks():
     print("[SERVER LOG] Starting background tasks...")
     tasks_completed = 0
@@ -1129,6 +1245,11 @@ def periodic_save_loop(interval):
             print(f"[SERVER LOG] Error in periodic save loop: {str(e)}")
             # Avoid busy-looping on error
             time.sleep(interval)
+
+# Started at import time: under gunicorn this module is imported, never run as __main__,
+# and app.run() blocks until shutdown anyway
+save_thread = threading.Thread(target=periodic_save_loop, args=(SAVE_INTERVAL_SECONDS,), daemon=True)
+save_thread.start()
 # -----------------------------
 
 # Create a storage for forwarded messages
@@ -1138,8 +1259,6 @@ FORWARD_BATCH_TIMEOUT = 3  # seconds to wait for more forwarded messages
 def generate_and_send_personal_note(chat_id, user_id, username, memory_context, user_impression):
     print(f"[SERVER LOG] Generating personal note for {username} in chat {chat_id}")
     personal_prompt = f"""
-    {PERSONALITY}
-    
     Напиши коротке особисте повідомлення для користувача {username} на основі всього, що я знаю про цю людину.
     Це повинна бути щира, особиста замітка від мене (Анни) до цієї людини.
     Не більше 3 речень. Повідомлення повинно бути дуже особистим і показувати, що я уважна до деталей
@@ -1156,6 +1275,7 @@ def generate_and_send_personal_note(chat_id, user_id, username, memory_context,
              client_response = client.models.generate_content(
                  model="gemini-2.0-flash",
                  contents=personal_prompt,
+                 config=PERSONA_CONFIG,
              )
              personal_note = client_response.text.strip()
              # Send the note as a separate message (without reply)
@@ -1257,39 +1377,82 @@ def handle_help_command(chat_id):
     context_manager.add_message(chat_id, None, CONFIG["bot_name"], response, is_bot=True, is_group=context_manager.is_group_chat(chat_id))
     return None # Indicate message was sent internally
 
+def send_generated_response(chat_id, prompt, user_id, username, reply_id, is_group):
+    """Generate a reply to prompt and send it to the chat. Runs on RESPONSE_EXECUTOR"""
+    try:
+        # Send typing indicator while the reply is generated
+        send_typing_action(chat_id)
+
+        # Generate response using user context
+        response_text = generate_response(prompt, chat_id, user_id, username)
+
+        # Send response
+        send_message(chat_id, response_text, reply_to_message_id=reply_id)
+
+        # Add bot's response to context
+        context_manager.add_message(chat_id, None, CONFIG["bot_name"], response_text, is_bot=True, is_group=is_group)
+
+        # Always schedule potential follow-up task (delay happens in background check)
+        schedule_followup_task(chat_id, user_id, username, response_text)
+
+    except Exception as e:
+        print(f"Error generating response: {str(e)}")
+        # Send error message without reply
+        try:
+            send_message(chat_id, "вибач, щось пішло не так. спробуй ще раз через хвилину")
+        except Exception as send_error:
+            print(f"Error sending error message: {str(send_error)}")
+
+GROUP_CHAT_TYPES = frozenset(('group', 'supergroup'))
+
+# Settings the webhook reads on every update, looked up once (the config is only loaded at startup)
+RESPONSE_COMMANDS = CONFIG["response_settings"].get("commands", {})
+RESPOND_TO_REPLIES = CONFIG["response_settings"].get("respond_to_replies", True)
+BOT_NAME_LOWER = CONFIG.get('bot_name', '').lower()
+INCLUDE_REPLY_CONTEXT = group_settings.get("include_reply_context", True)
+SESSION_ENABLED = group_settings.get("session_enabled", True)
+AUTO_JOIN_SESSION = group_settings.get("auto_join_session", True)
+AUTO_REPLY_TO_SESSION_PARTICIPANTS = group_settings.get("auto_reply_to_session_participants", True)
+MESSAGE_BATCHING_ENABLED = CONFIG.get("message_batching", {}).get("enabled", True)
+
 @app.route('/webhook', methods=['POST'])
 def webhook():
     """Handle incoming webhook from Telegram"""
     global message_batches, forwarded_batches
     
-    data = request.get_json()
+    # Parsed with storage.loads (orjson when installed) straight from the body bytes
+    try:
+        data = storage.loads(request.get_data(cache=False))
+    except ValueError as e:
+        print(f"Invalid webhook payload: {str(e)}")
+        return 'OK'
     print(f"Received webhook data")
 
     # Periodically check token usage
     check_token_usage()
 
     # Run background tasks in a separate thread
-    background_thread = threading.Thread(target=run_background_tasks)
-    background_thread.start()
+    start_background_tasks()
 
     # Check if this is a message update
-    if 'message' not in data:
+    message = data.get('message') if isinstance(data, dict) else None
+    if message is None:
         return 'OK'
     
-    message = data['message']
-    
     # Extract message information
-    chat_id = message.get('chat', {}).get('id')
-    user_id = message.get('from', {}).get('id')
-    username = message.get('from', {}).get('username', message.get('from', {}).get('first_name', 'User'))
+    chat = message.get('chat', {})
+    sender = message.get('from', {})
+    chat_id = chat.get('id')
+    user_id = sender.get('id')
+    username = sender.get('username', sender.get('first_name', 'User'))
     message_id = message.get('message_id', 0) # Get message_id for replies
     
     # Skip messages from the bot itself
-    if message.get('from', {}).get('is_bot', False):
+    if sender.get('is_bot', False):
         return 'OK'
     
     # Check if this is a group chat
-    is_group = message.get('chat', {}).get('type') in ['group', 'supergroup']
+    is_group = chat.get('type') in GROUP_CHAT_TYPES
     
     # Update scheduled messenger if enabled
     if scheduled_messenger and chat_id:
@@ -1329,14 +1492,14 @@ def webhook():
                 if replied_user_info.get('is_bot'):
                     # Check if it's *this* bot
                     # A more robust check would involve getting the bot's own ID via getMe
-                    bot_username_from_config = CONFIG.get('bot_name', '').lower()
+                    bot_username_from_config = BOT_NAME_LOWER
                     replied_bot_username = replied_user_info.get('username', '').lower()
                     replied_bot_firstname = replied_user_info.get('first_name', '').lower()
                     if bot_username_from_config in replied_bot_username or bot_username_from_config in replied_bot_firstname:
                         is_reply_to_bot = True
 
             # Add reply context if enabled
-            if CONFIG.get("group_chat_settings", {}).get("include_reply_context", True):
+            if INCLUDE_REPLY_CONTEXT:
                 reply_context = f"[У відповідь на повідомлення від {replied_username}: \"{replied_text}\"] "
                 message_text = reply_context + message_text
 
@@ -1377,7 +1540,7 @@ def webhook():
             return 'OK'
 
         # Check for predefined commands
-        commands = CONFIG["response_settings"].get("commands", {})
+        commands = RESPONSE_COMMANDS
         for cmd, response in commands.items():
             if message_text.startswith(cmd):
                 # Send command response without reply
@@ -1386,7 +1549,7 @@ def webhook():
                 return 'OK'
 
         # Determine if bot should respond
-        should_force_respond = is_reply_to_bot and CONFIG["response_settings"].get("respond_to_replies", True)
+        should_force_respond = is_reply_to_bot and RESPOND_TO_REPLIES
         keyword_match = should_respond(message_text) or should_force_respond
 
         # If we shouldn't respond, check if we're in an active session
@@ -1408,14 +1571,14 @@ def webhook():
                     return 'OK'
 
                 # Auto reply to session participants if enabled
-                if (is_group and CONFIG.get("group_chat_settings", {}).get("auto_reply_to_session_participants", True)) or not is_group:
+                if (is_group and AUTO_REPLY_TO_SESSION_PARTICIPANTS) or not is_group:
                     keyword_match = True
-            elif is_group and CONFIG.get("group_chat_settings", {}).get("auto_join_session", True) and context_manager.is_session_active(chat_id):
+            elif is_group and AUTO_JOIN_SESSION and context_manager.is_session_active(chat_id):
                 # Add user to session
                 context_manager.update_session(chat_id, user_id, username)
 
         # Special handling for forwarded messages - they get batched by chat_id
-        if is_forwarded and CONFIG.get("message_batching", {}).get("enabled", True):
+        if is_forwarded and MESSAGE_BATCHING_ENABLED:
             forward_batch_key = f"forward:{chat_id}"
             current_time = time.time()
 
@@ -1465,10 +1628,10 @@ def webhook():
                     # Only respond if the bot would respond to normal messages in this context
                     if should_respond(message_text) or should_force_respond or (
                             batch_is_group and context_manager.is_session_active(chat_id, initiator_id) and
-                            CONFIG.get("group_chat_settings", {}).get("auto_reply_to_session_participants", True)):
+                            AUTO_REPLY_TO_SESSION_PARTICIPANTS):
 
                         # Start or update session for group chats if needed
-                        if batch_is_group and CONFIG.get("group_chat_settings", {}).get("session_enabled", True):
+                        if batch_is_group and SESSION_ENABLED:
                             if not context_manager.is_session_active(chat_id):
                                 context_manager.start_session(chat_id, initiator_id, initiator_name)
                             else:
@@ -1477,26 +1640,11 @@ def webhook():
                         # Prepare combined input text
                         combined_input = f"Користувач {initiator_name} переслав кілька повідомлень:\n\n" + "\n".join(batched_forwards)
 
-                        # Send typing indicator
-                        send_typing_action(chat_id)
-
-                        # Generate response using user context
-                        response_text = generate_response(combined_input, chat_id, initiator_id, initiator_name)
-
-                        # Send typing action with dynamic timing
-                        send_typing_action(chat_id, response_text)
-
                         # Determine reply ID (use the original message ID that triggered the batch)
                         reply_id = message_id if batch_is_group else None
 
-                        # Send the response
-                        send_message(chat_id, response_text, reply_to_message_id=reply_id)
-
-                        # Add bot's response to context
-                        context_manager.add_message(chat_id, None, CONFIG["bot_name"], response_text, is_bot=True, is_group=batch_is_group)
-
-                        # Always schedule potential follow-up task (delay happens in background check)
-                        schedule_followup_task(chat_id, initiator_id, initiator_name, response_text)
+                        RESPONSE_EXECUTOR.submit(send_generated_response, chat_id, combined_input,
+                                                 initiator_id, initiator_name, reply_id, batch_is_group)
 
                 return 'OK'
 
@@ -1505,85 +1653,53 @@ def webhook():
         current_time = time.time()
 
         # Check if this is a message that needs a response, check batching
-        if keyword_match and CONFIG.get("message_batching", {}).get("enabled", True) and not is_forwarded:
-            # Add to batch if there's an active batch for this user in this chat
-            if batch_key in message_batches and current_time - message_batches[batch_key]['last_update'] < MESSAGE_BATCH_TIMEOUT:
-                # Add to existing batch
-                message_batches[batch_key]['messages'].append(message_text)
-                message_batches[batch_key]['message_ids'].append(message_id) # Store message ID
-                message_batches[batch_key]['last_update'] = current_time
-                # Return immediately to let more messages accumulate if they're coming
-                return 'OK'
-            else:
+        if keyword_match and MESSAGE_BATCHING_ENABLED and not is_forwarded:
+            with message_batches_lock:
+                batch = message_batches.get(batch_key)
+                if batch is not None:
+                    # Add to existing batch, the timer answers all of them once the user pauses
+                    batch['messages'].append(message_text)
+                    batch['message_ids'].append(message_id) # Store message ID
+                    batch['last_update'] = current_time
+                    if len(batch['messages']) >= MAX_BATCH_MESSAGES:
+                        schedule_batch_flush(batch_key, 0)
+                    return 'OK'
                 # Create new batch
                 message_batches[batch_key] = {
                     'messages': [message_text],
                     'message_ids': [message_id], # Store message ID
                     'username': username,
                     'user_id': user_id,
+                    'chat_id': chat_id,
                     'is_group': is_group,
                     'created': current_time,
                     'last_update': current_time
                 }
 
-                # Wait for potential additional messages
-                # time.sleep(MESSAGE_BATCH_TIMEOUT) # Removed sleep for performance
-
-                # Get all messages in batch
-                batched_messages = message_batches[batch_key]['messages']
-                batch_user_id = message_batches[batch_key]['user_id']
-                # Use the ID of the *first* message in the batch for potential reply
-                batch_reply_trigger_id = message_batches[batch_key]['message_ids'][0]
-
-                # Clean up the batch
-                del message_batches[batch_key]
-
-                # Check if session already exists or create one for group and private chats
-                if is_group and CONFIG.get("group_chat_settings", {}).get("session_enabled", True):
-                    if not context_manager.is_session_active(chat_id):
-                        # Start a new session
-                        context_manager.start_session(chat_id, user_id, username)
-                    else:
-                        # Update existing session
-                        context_manager.update_session(chat_id, user_id, username)
-                elif not is_group:
-                    # For private chats, always maintain a session
-                    if not context_manager.is_session_active(chat_id):
-                        context_manager.start_session(chat_id, user_id, username)
-                    else:
-                        context_manager.update_session(chat_id, user_id, username)
-
-                # If we have multiple messages, combine them for a single response
-                if len(batched_messages) > 1:
-                    combined_input = "Користувач надіслав кілька повідомлень:\n\n" + "\n".join([f"- {msg}" for msg in batched_messages])
-                    response_text = generate_response(combined_input, chat_id, batch_user_id, username)
-
-                    # Send typing action with message length for dynamic typing duration
-                    send_typing_action(chat_id, response_text)
-
-                    # Determine reply ID (use the first message ID of the batch if group)
-                    reply_id = batch_reply_trigger_id if is_group else None
-                    send_message(chat_id, response_text, reply_to_message_id=reply_id)
-
-                    # Add bot response to context
-                    context_manager.add_message(chat_id, None, CONFIG["bot_name"], response_text, is_bot=True, is_group=is_group)
-
-                    # Always schedule potential follow-up task (delay happens in background check)
-                    schedule_followup_task(chat_id, batch_user_id, username, response_text)
-
-                    return 'OK'
+            # Check if session already exists or create one for group and private chats
+            if is_group and SESSION_ENABLED:
+                if not context_manager.is_session_active(chat_id):
+                    # Start a new session
+                    context_manager.start_session(chat_id, user_id, username)
                 else:
-                    # Single message processing continues with normal flow
-                    message_text = batched_messages[0]
-                    # Use the stored message ID for potential reply
-                    triggering_message_id = batch_reply_trigger_id
+                    # Update existing session
+                    context_manager.update_session(chat_id, user_id, username)
+            elif not is_group:
+                # For private chats, always maintain a session
+                if not context_manager.is_session_active(chat_id):
+                    context_manager.start_session(chat_id, user_id, username)
+                else:
+                    context_manager.update_session(chat_id, user_id, username)
 
+            # Wait for potential additional messages without holding the request
+            schedule_batch_flush(batch_key, MESSAGE_BATCH_TIMEOUT)
+            return 'OK'
 
-        # Process the message if we should respond (this handles single messages or fall-through from batching)
+        # Process the message if we should respond (used when batching is off)
         if keyword_match:
             try:
                 # Start or update session for both group chats and private chats
-                if is_group and CONFIG.get("group_chat_settings", {}).get("session_enabled", True):
+                if is_group and SESSION_ENABLED:
                     if not context_manager.is_session_active(chat_id):
                         # Start new session
                         context_manager.start_session(chat_id, user_id, username)
@@ -1599,26 +1715,14 @@ def webhook():
                         # Update existing session
                         context_manager.update_session(chat_id, user_id, username)
 
-                # Send typing indicator
-                send_typing_action(chat_id)
-
-                # Generate response using user context
-                response_text = generate_response(message_text, chat_id, user_id, username)
-
                 # Determine reply ID (use triggering_message_id if group)
                 reply_id = triggering_message_id if is_group else None
 
-                # Send response
-                send_message(chat_id, response_text, reply_to_message_id=reply_id)
-
-                # Add bot's response to context
-                context_manager.add_message(chat_id, None, CONFIG["bot_name"], response_text, is_bot=True, is_group=is_group)
-
-                # Always schedule potential follow-up task (delay happens in background check)
-                schedule_followup_task(chat_id, user_id, username, response_text)
+                RESPONSE_EXECUTOR.submit(send_generated_response, chat_id, message_text,
+                                         user_id, username, reply_id, is_group)
 
             except Exception as e:
-                print(f"Error generating response: {str(e)}")
+                print(f"Error starting response: {str(e)}")
                 # Send error message without reply
                 send_message(chat_id, "вибач, щось пішло не так. спробуй ще раз через хвилину")
 
@@ -1630,8 +1734,4 @@ def index():
     return "Bot is running!"
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 8080)))
-
-    # Start the periodic save thread
-    save_thread = threading.Thread(target=periodic_save_loop, args=(SAVE_INTERVAL_SECONDS,), daemon=True)
-    save_thread.start() 
\ No newline at end of file
+    app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 8080))) 
\ No newline at end of file
@@ -8,14 +8,21 @@ import requests
 from google import genai
 # from google.api_core.client_options import HttpOptions
 from personality import PERSONALITY
+import storage
 
 class ScheduledMessenger:
     """
     Handles sending periodic messages from the bot based on personality and memory
     """
-    def __init__(self, telegram_token, gemini_api_key, memory_file="memory.json", config_file="config.json"):
+    def __init__(self, telegram_token, gemini_api_key, memory_file="memory.json", config_file="config.json", context_manager=None,
+                 http_session=None, config=None):
         self.telegram_token = telegram_token
+        self.api_url = f"https://api.telegram.org/bot{telegram_token}/"
+        # Keep-alive session for the Telegram API, main passes its own so both share the connections
+        self.http_session = http_session or requests.Session()
         self.memory_file = memory_file
+        # When set, chat memory is read from the ContextManager store instead of memory_file
+        self.context_manager = context_manager
         self.config_file = config_file
         self.chats_to_message = {}  # Will store chat_ids with timestamps of last activity
         self.last_sent_times = {}  # When messages were last sent to each chat
@@ -56,8 +63,8 @@ class ScheduledMessenger:
         except Exception as e:
              print(f"[ScheduledMessenger] Error initializing Gemini client: {str(e)}")
         
-        # Load config
-        self.config = self._load_config()
+        # Load config, unless the caller already has it parsed
+        self.config = config if config is not None else self._load_config()
         
         # Scheduling settings
         self.min_hours_between_messages = 4  # Minimum hours between messages
@@ -75,11 +82,13 @@ class ScheduledMessenger:
             return {}
     
     def _load_memory(self):
-        """Load memory from file"""
+        """Load memory from the context manager, or from file when running standalone"""
+        if self.context_manager is not None:
+            return self.context_manager.memory
         if os.path.exists(self.memory_file):
             try:
-                with open(self.memory_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
+                with open(self.memory_file, 'rb') as f:
+                    return storage.loads(f.read())
             except Exception as e:
                 print(f"Error loading memory: {str(e)}")
         return {}
@@ -89,7 +98,8 @@ class ScheduledMessenger:
         chat_id_str = str(chat_id)
         if chat_id_str not in self.chats_to_message:
             self.chats_to_message[chat_id_str] = {
-                "last_activity": datetime.now().isoformat(),
+                # Monotonic seconds: the dict lives only in this process and is checked on every scheduler pass
+                "last_activity_ts": time.monotonic(),
                 "chat_type": chat_type,
                 "active": True
             }
@@ -98,7 +108,7 @@ class ScheduledMessenger:
         """Update the last activity time for a chat"""
         chat_id_str = str(chat_id)
         if chat_id_str in self.chats_to_message:
-            self.chats_to_message[chat_id_str]["last_activity"] = datetime.now().isoformat()
+            self.chats_to_message[chat_id_str]["last_activity_ts"] = time.monotonic()
     
     def should_send_message(self, chat_id):
         """Determine if it's appropriate to send a message to this chat now"""
@@ -110,8 +120,8 @@ class ScheduledMessenger:
         now = datetime.now()
         
         # Check if chat had recent activity
-        last_activity = datetime.fromisoformat(self.chats_to_message[chat_id_str]["last_activity"])
-        if now - last_activity < timedelta(minutes=self.active_session_cooldown_minutes):
+        idle_seconds = time.monotonic() - self.chats_to_message[chat_id_str]["last_activity_ts"]
+        if idle_seconds < self.active_session_cooldown_minutes * 60:
             # Don't send if there was recent activity (active conversation)
             return False
             
@@ -182,7 +192,7 @@ class ScheduledMessenger:
         memory_context = self._get_memory_context(chat_id)
         
         # Build prompt for a proactive message
-        prompt = PERSONALITY + "\n\n"
+        prompt = ""
         
         if memory_context:
             prompt += memory_context + "\n\n"
@@ -199,6 +209,7 @@ class ScheduledMessenger:
             response = self.client.models.generate_content(
                 model="gemini-2.0-flash",
                 contents=prompt,
+                config={"system_instruction": PERSONALITY},
             )
             message = response.text.strip()
             
@@ -215,13 +226,13 @@ class ScheduledMessenger:
     def send_message(self, chat_id, text):
         """Send message to Telegram chat"""
         # First send typing action to show "Анна печатает..."
-        typing_url = f"https://api.telegram.org/bot{self.telegram_token}/sendChatAction"
+        typing_url = self.api_url + "sendChatAction"
         typing_payload = {
             "chat_id": chat_id,
             "action": "typing"
         }
         try:
-            requests.post(typing_url, json=typing_payload)
+            self.http_session.post(typing_url, json=typing_payload, timeout=10)
             
             # Calculate typing time based on message length
             # 30ms per character with min/max bounds
@@ -232,14 +243,14 @@ class ScheduledMessenger:
             print(f"Error sending typing action: {str(e)}")
         
         # Now send the actual message
-        url = f"https://api.telegram.org/bot{self.telegram_token}/sendMessage"
+        url = self.api_url + "sendMessage"
         payload = {
             "chat_id": chat_id,
             "text": text,
             "parse_mode": "Markdown"
         }
         try:
-            response = requests.post(url, json=payload)
+            response = self.http_session.post(url, json=payload, timeout=10)
             result = response.json()
             
             if result.get("ok"):
@@ -255,18 +266,24 @@ class ScheduledMessenger:
     
     def update_active_chats(self):
         """Update which chats should receive messages based on activity"""
-        memory = self._load_memory()
+        if self.context_manager is not None:
+            # Kept apart from the chat rows, walking the store would load every dormant chat
+            last_interactions = self.context_manager.get_last_interactions()
+        else:
+            last_interactions = {chat_id: chat_data["last_interaction"]
+                                 for chat_id, chat_data in self._load_memory().items()
+                                 if "last_interaction" in chat_data}
         
-        for chat_id, chat_data in memory.items():
+        now = datetime.now()
+        for chat_id, last_interaction_iso in last_interactions.items():
             # Check if chat has had an interaction in the past 30 days
-            if "last_interaction" in chat_data:
-                try:
-                    last_interaction = datetime.fromisoformat(chat_data["last_interaction"])
-                    if datetime.now() - last_interaction <= timedelta(days=30):
-                        # Chat is active enough to receive messages
-                        self.register_chat(chat_id)
-                except Exception as e:
-                    print(f"Error parsing date for chat {chat_id}: {str(e)}")
+            try:
+                last_interaction = datetime.fromisoformat(last_interaction_iso)
+                if now - last_interaction <= timedelta(days=30):
+                    # Chat is active enough to receive messages
+                    self.register_chat(chat_id)
+            except Exception as e:
+                print(f"Error parsing date for chat {chat_id}: {str(e)}")
     
     def check_and_send_scheduled_messages(self):
         """Check if it's time to send a message to any chat and send if appropriate"""
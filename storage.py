@@ -0,0 +1,212 @@
+"""
+Helpers shared by the modules that persist bot state to disk.
+Uses orjson when it is installed and falls back to the standard json module otherwise.
+Per-chat rows in SQLite are stored as msgpack when it is installed, JSON otherwise.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+from collections.abc import MutableMapping
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+def dumps(data):
+    """Serialize data to compact UTF-8 encoded JSON bytes"""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def loads(payload):
+    """Parse JSON from bytes or str. Decode errors are raised as json.JSONDecodeError"""
+    if orjson is not None:
+        return orjson.loads(payload)
+    return json.loads(payload)
+
+
+def atomic_write(path, payload, durable=False):
+    """
+    Write payload to a temporary file next to path and swap it in with os.replace,
+    so a crash mid-write never leaves a truncated file behind.
+    With durable=True the data is also synced to disk before the swap
+    """
+    tmp_path = path + ".tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        # One write() for the whole payload; loop only in case the OS accepts it partially
+        view = memoryview(payload)
+        while view:
+            view = view[os.write(fd, view):]
+        if durable:
+            # fdatasync skips the metadata flush where the platform has it
+            getattr(os, "fdatasync", os.fsync)(fd)
+    finally:
+        os.close(fd)
+    os.replace(tmp_path, path)
+
+
+def pack(data):
+    """Serialize data to compact binary for SQLite rows: msgpack, or JSON bytes without it"""
+    if msgpack is not None:
+        return msgpack.packb(data, use_bin_type=True)
+    return dumps(data)
+
+
+def unpack(payload):
+    """Parse a row written by pack(). JSON rows are read too, whichever format is active"""
+    # A JSON document starts with "{" or "[", a msgpack map or array never does
+    if payload[:1] in (b"{", b"["):
+        return loads(payload)
+    if msgpack is None:
+        raise ValueError("msgpack is required to read this row")
+    return msgpack.unpackb(payload, raw=False)
+
+
+class SqliteStore(MutableMapping):
+    """
+    Dict-like view over a SQLite table of JSON documents, one row per key.
+    Only the key list is read when the store is opened; a row is parsed on first
+    access and stays cached in-process. Values are mutated in place by the callers,
+    so they report changes with mark_dirty() and flush() writes only those rows.
+    With max_cached set, flush() also drops clean rows that were not used since the
+    previous flush once the cache holds more than max_cached rows; they are read again on demand.
+    """
+    def __init__(self, path, table="mem", durable=False, max_cached=None):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self._table = table
+        # One connection shared by the Flask and background threads, guarded by _lock
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # NORMAL in WAL mode can lose the last commits on power loss but never corrupts the file
+        self._db.execute("PRAGMA synchronous=FULL" if durable else "PRAGMA synchronous=NORMAL")
+        self._db.execute(f"CREATE TABLE IF NOT EXISTS {table}(id TEXT PRIMARY KEY, data BLOB)")
+        self._lock = threading.RLock()
+        self._cache = {}
+        self._dirty_keys = set()
+        self._max_cached = max_cached
+        # Keys read since the last flush. A caller may still be changing such a row and report it
+        # with mark_dirty() afterwards, which only works while the row stays in the cache
+        self._used_keys = set()
+        self._keys = {row[0] for row in self._db.execute(f"SELECT id FROM {table}")}
+
+    def __getitem__(self, key):
+        if self._max_cached is not None:
+            self._used_keys.add(key)
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+        with self._lock:
+            if key in self._cache:
+                return self._cache[key]
+            if key not in self._keys:
+                raise KeyError(key)
+            row = self._db.execute(f"SELECT data FROM {self._table} WHERE id=?", (key,)).fetchone()
+            if row is None:
+                self._keys.discard(key)
+                raise KeyError(key)
+            value = unpack(row[0])
+            self._cache[key] = value
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._cache[key] = value
+            self._keys.add(key)
+            self._dirty_keys.add(key)
+
+    def __delitem__(self, key):
+        with self._lock:
+            if key not in self._keys:
+                raise KeyError(key)
+            self._keys.discard(key)
+            self._cache.pop(key, None)
+            self._dirty_keys.discard(key)
+            self._db.execute(f"DELETE FROM {self._table} WHERE id=?", (key,))
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __iter__(self):
+        # Iterate over a snapshot so other threads can add chats meanwhile
+        return iter(list(self._keys))
+
+    def __len__(self):
+        return len(self._keys)
+
+    def scan(self):
+        """
+        Yield (key, value) for every row without adding the rows to the cache.
+        Rows already cached are returned from the cache, so unsaved changes are included
+        """
+        with self._lock:
+            cached = dict(self._cache)
+            rows = self._db.execute(f"SELECT id, data FROM {self._table}").fetchall()
+        for key, payload in rows:
+            if key in cached:
+                yield key, cached.pop(key)
+            else:
+                yield key, unpack(payload)
+        # Added since the last flush, not in the table yet
+        yield from cached.items()
+
+    def mark_dirty(self, key):
+        """Record that the cached value of key was changed in place"""
+        with self._lock:
+            if key in self._cache:
+                self._dirty_keys.add(key)
+
+    def flush(self):
+        """Write the changed rows back in a single transaction, returns how many were written"""
+        with self._lock:
+            written = self._write_dirty()
+            if self._max_cached is not None:
+                self._trim_cache()
+            return written
+
+    def _write_dirty(self):
+        """Body of flush(), runs under _lock"""
+        if not self._dirty_keys:
+            return 0
+        keys = self._dirty_keys
+        self._dirty_keys = set()
+        try:
+            rows = [(key, pack(self._cache[key])) for key in keys]
+            self._db.execute("BEGIN")
+            try:
+                self._db.executemany(
+                    f"INSERT OR REPLACE INTO {self._table}(id, data) VALUES (?, ?)", rows)
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+        except Exception:
+            # Keep the rows for the next attempt
+            self._dirty_keys |= keys
+            raise
+        return len(rows)
+
+    def _trim_cache(self):
+        """Drop unused clean rows above max_cached, runs under _lock"""
+        excess = len(self._cache) - self._max_cached
+        if excess > 0:
+            for key in [k for k in self._cache if k not in self._dirty_keys and k not in self._used_keys]:
+                del self._cache[key]
+                excess -= 1
+                if not excess:
+                    break
+        self._used_keys = set()
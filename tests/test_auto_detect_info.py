@@ -0,0 +1,97 @@
+"""
+_auto_detect_important_info has to record the same information as the original
+implementation, which ran every rule with its own re.search
+"""
+
+import os
+import re
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from context_manager import ContextManager
+
+
+def reference_detect(message):
+    """The original rule-by-rule detection, returns the add_to_memory calls it makes"""
+    calls = []
+    personal_info_patterns = [
+        (r"(?:мене|я) (?:звати|звуть|кличуть|називають|називаюсь) (\w+)", "ім'я"),
+        (r"(?:моє|мене) (?:ім'я|звати|звуть) (\w+)", "ім'я"),
+        (r"(?:мені|я маю|мій вік) (\d+) (?:рок[иіу]в|літ|років)", "вік"),
+        (r"(?:я|ми) (?:живу|живемо|мешкаю|з) (?:в|у) ([\w\s]+)", "місце"),
+        (r"(?:я|мені) (?:подобається|люблю|обожнюю) ([\w\s]+)", "інтереси"),
+        (r"(?:моє|мені) (?:хобі|захоплення) (?:це|—|-)? ?([\w\s]+)", "хобі")
+    ]
+    topic_patterns = [
+        r"(?:давай|можемо|хочу|цікавить|поговоримо|розкажи) про ([\w\s]+)",
+        r"(?:мене цікавить тема|тема|питання щодо) ([\w\s]+)",
+        r"(?:що ти думаєш про|як щодо|твоя думка про) ([\w\s]+)"
+    ]
+    fact_patterns = [
+        r"(?:важливо|запам'ятай|не забудь|нагадую|важливий факт)[,:] (.*)",
+        r"(?:запам'ятай|збережи|занотуй)[,:] (.*)",
+        r"(?:я хочу щоб ти знала|тобі варто знати)[,:] (.*)"
+    ]
+    for pattern, info_type in personal_info_patterns:
+        matches = re.search(pattern, message.lower())
+        if matches:
+            value = matches.group(1).strip()
+            if value and len(value) > 1:
+                calls.append(("user_info", {info_type: value}))
+    for pattern in topic_patterns:
+        matches = re.search(pattern, message.lower())
+        if matches:
+            topic = matches.group(1).strip()
+            if topic and len(topic) > 2:
+                calls.append(("topics_discussed", topic))
+    for pattern in fact_patterns:
+        matches = re.search(pattern, message)
+        if matches:
+            fact = matches.group(1).strip()
+            if fact and len(fact) > 3:
+                calls.append(("important_facts", fact))
+    return calls
+
+
+MESSAGES = [
+    # Matches of different rules overlap
+    "мені подобається тема космосу",
+    "я живу в Києві і мені подобається тема історії",
+    "мене цікавить тема що ти думаєш про кіно",
+    "давай про музику, що ти думаєш про джаз",
+    "мене звати Олег і моє ім'я рідкісне",
+    "мені 25 років, моє хобі це футбол",
+    "Запам'ятай: завтра зустріч. Важливо: взяти ключі",
+    "я хочу щоб ти знала: я люблю каву",
+    "ми живемо у Львові, розкажи про Львів",
+    # No match
+    "привіт",
+    "як справи сьогодні?",
+    "про",
+]
+
+
+class AutoDetectImportantInfoTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cm = ContextManager(memory_file=os.path.join(self.tmp_dir.name, "memory.json"))
+        self.calls = []
+        self.cm.add_to_memory = lambda chat_id, category, value, **kwargs: self.calls.append((category, value))
+
+    def tearDown(self):
+        self.cm._worker.submit(lambda: None).result()
+        self.tmp_dir.cleanup()
+
+    def test_matches_rule_by_rule_detection(self):
+        for message in MESSAGES:
+            with self.subTest(message=message):
+                self.calls.clear()
+                self.cm._auto_detect_important_info("1", "2", message)
+                self.assertEqual(self.calls, reference_detect(message))
+
+
+if __name__ == "__main__":
+    unittest.main()
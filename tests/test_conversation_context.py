@@ -0,0 +1,73 @@
+"""
+get_conversation_context has to format the history the same way as the original
+implementation, which built the text from the message dicts on every call
+"""
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from context_manager import ContextManager
+
+
+def reference_context(history):
+    """The original get_conversation_context over a list of message dicts"""
+    if not history:
+        return ""
+
+    formatted_context = "Previous conversation:\n\n"
+    for msg in history:
+        speaker = "Bot" if msg["is_bot"] else f"User ({msg['username'] if msg['username'] else 'Unknown'})"
+        formatted_context += f"{speaker}: {msg['content']}\n"
+
+    return formatted_context
+
+
+MESSAGES = [
+    # (chat_id, user_id, username, content, is_bot)
+    (1, 10, "oleh", "привіт", False),
+    (1, None, "Анна", "привіт, олеже", True),
+    ("1", 11, None, "а я без імені", False),
+    (1, 12, "", "і я", False),
+    (2, 10, "oleh", "інший чат", False),
+    (1, 10, "oleh", "Анна, як справи?\nдругий рядок", False),
+    (1, None, "Анна", "норм", True),
+    (1, 11, "maria", "тепер з іменем", False),
+    (2, None, "Анна", "відповідь в іншому чаті", True),
+    (1, 10, "oleh", "", False),
+    (1, 12, "ivan", "останнє", False),
+]
+
+
+class ConversationContextTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cm = ContextManager(max_messages=4, memory_file=os.path.join(self.tmp_dir.name, "memory.json"))
+        self.cm._auto_detect_important_info = lambda *args, **kwargs: None
+
+    def tearDown(self):
+        self.cm._worker.submit(lambda: None).result()
+        self.tmp_dir.cleanup()
+
+    def test_matches_original_formatting(self):
+        self.assertEqual(self.cm.get_conversation_context(1), reference_context([]))
+        histories = {}
+        for chat_id, user_id, username, content, is_bot in MESSAGES:
+            self.cm.add_message(chat_id, user_id, username, content, is_bot=is_bot)
+            history = histories.setdefault(str(chat_id), [])
+            history.append({"username": username, "content": content, "is_bot": is_bot})
+            # The original kept max_messages entries per chat as well
+            del history[:-self.cm.max_messages]
+            for other_chat_id, other_history in histories.items():
+                with self.subTest(added=content, chat_id=other_chat_id):
+                    expected = reference_context(other_history)
+                    self.assertEqual(self.cm.get_conversation_context(other_chat_id), expected)
+                    # The second call is answered from the per-chat cache
+                    self.assertEqual(self.cm.get_conversation_context(int(other_chat_id)), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
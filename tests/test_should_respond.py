@@ -0,0 +1,154 @@
+"""
+build_should_respond has to give the same answers as the original should_respond,
+which read the trigger settings from CONFIG and checked every keyword on its own
+"""
+
+import itertools
+import os
+import re
+import string
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import triggers
+
+
+def reference_should_respond(config, text):
+    """The original should_respond, with CONFIG passed in"""
+    # Always respond to direct messages if enabled
+    if config["response_settings"]["respond_to_direct_messages"] and text.startswith('/'):
+        return True
+
+    # Check for keywords
+    if not config["trigger_detection"]["enabled"]:
+        return False
+
+    # Prepare text for comparison
+    check_text = text
+    if not config["trigger_detection"]["case_sensitive"]:
+        check_text = text.lower()
+        keywords = [k.lower() for k in config["keywords"]]
+        ignored_phrases = [p.lower() for p in config["trigger_detection"].get("ignored_phrases", [])]
+    else:
+        keywords = config["keywords"]
+        ignored_phrases = config["trigger_detection"].get("ignored_phrases", [])
+
+    # Check for ignored phrases
+    for phrase in ignored_phrases:
+        if phrase in check_text.lower():
+            return False
+
+    # Check if message should be at the beginning
+    must_be_at_beginning = config["trigger_detection"].get("must_be_at_beginning", False)
+
+    # Replace common punctuation with spaces to better isolate words
+    for punct in string.punctuation:
+        check_text = check_text.replace(punct, ' ')
+
+    # Check each keyword
+    for keyword in keywords:
+        if config["trigger_detection"]["whole_word_only"]:
+            # Use regex to check for whole word match with word boundaries
+            pattern = r'\b' + re.escape(keyword) + r'\b'
+
+            if must_be_at_beginning:
+                # Check if keyword is at the beginning of the message
+                pattern = r'^\s*' + pattern
+
+            # Try to match on original text
+            if re.search(pattern, check_text):
+                return True
+
+            # Also check for the keyword at the beginning without proper spacing
+            if re.search(r'^' + re.escape(keyword), check_text.replace(' ', '')):
+                return True
+        else:
+            # Check for substring match
+            if must_be_at_beginning:
+                # Check if keyword is at the beginning of the message
+                words = check_text.split()
+                if words and keyword in words[0]:
+                    return True
+            else:
+                if keyword in check_text:
+                    return True
+
+                # Check if the keyword is at the beginning without proper spacing
+                if check_text.replace(' ', '').startswith(keyword):
+                    return True
+
+    return False
+
+
+KEYWORDS = ["Анна", "Аня", "Ань", "Anna", "Ана"]
+IGNORED_PHRASES = ["моя подруга анна", "Знайома Аня"]
+
+MESSAGES = [
+    "Анна, привіт",
+    "анна привіт",
+    "привіт, Аня!",
+    "Аняпривіт",
+    "аня,як справи",
+    "Анночка, ти тут?",
+    "Ананас smoothie",
+    "Банан",
+    "  Anna are you there?",
+    "hey anna",
+    "що скаже Ань?",
+    "моя подруга анна прийде",
+    "Моя подруга Анна прийде",
+    "знайома аня теж",
+    "/start",
+    "/memory show",
+    "просто повідомлення",
+    "",
+    " ",
+    "...",
+    "(Аня)",
+    "вона сказала 'Анна'",
+]
+
+
+def make_config(enabled, case_sensitive, whole_word_only, must_be_at_beginning,
+                respond_to_direct_messages=True, keywords=KEYWORDS):
+    return {
+        "keywords": keywords,
+        "response_settings": {"respond_to_direct_messages": respond_to_direct_messages},
+        "trigger_detection": {
+            "enabled": enabled,
+            "case_sensitive": case_sensitive,
+            "whole_word_only": whole_word_only,
+            "must_be_at_beginning": must_be_at_beginning,
+            "ignored_phrases": IGNORED_PHRASES,
+        },
+    }
+
+
+CONFIGS = [make_config(*flags) for flags in itertools.product([True, False], repeat=4)]
+CONFIGS.append(make_config(True, False, True, False, respond_to_direct_messages=False))
+CONFIGS.append(make_config(True, False, True, False, keywords=[]))
+
+
+class ShouldRespondTest(unittest.TestCase):
+    def check_configs(self):
+        for config in CONFIGS:
+            should_respond = triggers.build_should_respond(config)
+            for message in MESSAGES:
+                with self.subTest(settings=config["trigger_detection"],
+                                  commands=config["response_settings"]["respond_to_direct_messages"],
+                                  keywords=bool(config["keywords"]), message=message):
+                    self.assertEqual(should_respond(message), reference_should_respond(config, message))
+
+    def test_matches_original_should_respond(self):
+        self.check_configs()
+
+    def test_matches_original_should_respond_without_ahocorasick(self):
+        with mock.patch.object(triggers, "ahocorasick", None):
+            self.check_configs()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,155 @@
+"""
+SqliteStore has to keep every change reported with mark_dirty across a flush and a reopen,
+and the stores have to take over memory.json / global_memory.json from older installs once
+"""
+
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import storage
+from context_manager import ContextManager
+from global_memory import GlobalMemory
+
+
+class SqliteStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "memory.db")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def reopen(self, **kwargs):
+        return storage.SqliteStore(self.path, **kwargs)
+
+    def test_rows_survive_flush_and_reopen(self):
+        store = self.reopen()
+        store["1"] = {"user_info": {"ім'я": "олег"}, "topics_discussed": ["кіно"]}
+        store["2"] = {"important_facts": []}
+        self.assertEqual(store.flush(), 2)
+        self.assertEqual(store.flush(), 0)
+
+        reopened = self.reopen()
+        self.assertEqual(sorted(reopened), ["1", "2"])
+        self.assertEqual(reopened["1"], {"user_info": {"ім'я": "олег"}, "topics_discussed": ["кіно"]})
+        self.assertEqual(reopened["2"], {"important_facts": []})
+
+    def test_change_in_place_is_written_after_mark_dirty(self):
+        store = self.reopen()
+        store["1"] = {"topics_discussed": []}
+        store.flush()
+
+        store["1"]["topics_discussed"].append("музика")
+        store.mark_dirty("1")
+        self.assertEqual(store.flush(), 1)
+
+        self.assertEqual(self.reopen()["1"], {"topics_discussed": ["музика"]})
+
+    def test_failed_write_keeps_rows_for_the_next_flush(self):
+        store = self.reopen()
+        store["1"] = {"value": 1}
+        store._db.execute("DROP TABLE mem")
+        with self.assertRaises(Exception):
+            store.flush()
+
+        store._db.execute("CREATE TABLE mem(id TEXT PRIMARY KEY, data BLOB)")
+        self.assertEqual(store.flush(), 1)
+        self.assertEqual(self.reopen()["1"], {"value": 1})
+
+    def test_trim_keeps_rows_used_since_the_last_flush(self):
+        store = self.reopen(max_cached=1)
+        for key in ("1", "2", "3"):
+            store[key] = {"value": key}
+        store.flush()
+        self.assertEqual(len(store._cache), 1)
+
+        row = store["1"]
+        store["2"]
+        store.flush()
+        # Read before the flush, so a mark_dirty after it still reaches the disk
+        row["value"] = "changed"
+        store.mark_dirty("1")
+        store.flush()
+
+        reopened = self.reopen()
+        self.assertEqual({key: reopened[key]["value"] for key in reopened},
+                         {"1": "changed", "2": "2", "3": "3"})
+
+    def test_scan_includes_unsaved_rows_without_caching(self):
+        store = self.reopen()
+        store["1"] = {"value": 1}
+        store["2"] = {"value": 2}
+        store.flush()
+        store["1"]["value"] = 10
+        store["3"] = {"value": 3}
+        self.assertEqual(dict(store.scan()), {"1": {"value": 10}, "2": {"value": 2}, "3": {"value": 3}})
+
+        reopened = self.reopen()
+        self.assertEqual(dict(reopened.scan()), {"1": {"value": 1}, "2": {"value": 2}})
+        self.assertEqual(reopened._cache, {})
+
+
+class MemoryMigrationTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write_json(self, name, data):
+        path = os.path.join(self.tmp_dir.name, name)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        return path
+
+    def open_context_manager(self, memory_file):
+        cm = ContextManager(memory_file=memory_file)
+        self.addCleanup(lambda: cm._worker.submit(lambda: None).result())
+        return cm
+
+    def test_memory_json_is_migrated_once(self):
+        memory_file = self.write_json("memory.json", {
+            "memory": {"1": {"topics_discussed": ["кіно"], "last_interaction": "2024-05-01T10:00:00"}},
+            "active_sessions": {},
+            "user_impressions_data": {"1:2": {"impression": "дружній", "needs_generation": False}},
+            "last_impression_update": {"1:2": 40},
+        })
+        cm = self.open_context_manager(memory_file)
+        self.assertEqual(cm.memory["1"]["topics_discussed"], ["кіно"])
+        self.assertEqual(cm.get_last_interactions(), {"1": "2024-05-01T10:00:00"})
+        self.assertTrue(cm.save_memory_if_dirty())
+
+        # memory.json is not read again once memory.db has the state
+        self.write_json("memory.json", {"memory": {"9": {"topics_discussed": []}}})
+        reopened = self.open_context_manager(memory_file)
+        self.assertEqual(sorted(reopened.memory), ["1"])
+        self.assertEqual(reopened.memory["1"]["topics_discussed"], ["кіно"])
+        self.assertEqual(reopened.user_impressions[("1", "2")]["impression"], "дружній")
+        self.assertEqual(reopened.get_last_interactions(), {"1": "2024-05-01T10:00:00"})
+
+    def test_global_memory_users_are_migrated_once(self):
+        memory_file = self.write_json("global_memory.json", {
+            "users": {"2": {"username": "oleh", "needs_profile_update": True}},
+            "chat_analytics": {},
+            "relationship_analyses": {},
+        })
+        config = {"global_memory_settings": {"memory_file": memory_file}}
+        memory = GlobalMemory(config)
+        self.assertEqual(memory.users["2"]["username"], "oleh")
+        self.assertTrue(memory.save_memory_if_dirty())
+
+        with open(memory_file, encoding="utf-8") as f:
+            self.assertNotIn("users", json.load(f))
+        reopened = GlobalMemory(config)
+        self.assertEqual(sorted(reopened.users), ["2"])
+        self.assertEqual(reopened.users["2"]["username"], "oleh")
+        self.assertEqual(reopened.get_users_needing_profile_updates(), ["2"])
+
+
+if __name__ == "__main__":
+    unittest.main()
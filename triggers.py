@@ -0,0 +1,105 @@
+"""
+Trigger detection: decides from the config whether a message should get a response.
+Uses pyahocorasick for the multi-phrase checks when it is installed and a regex alternation otherwise.
+"""
+
+import re
+import string
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+# Punctuation is replaced with spaces to better isolate words, see should_respond
+PUNCT_TABLE = str.maketrans({punct: ' ' for punct in string.punctuation})
+
+def build_substring_matcher(needles):
+    """
+    Return a function telling whether a text contains any of needles, checking all of them in one pass:
+    an Aho-Corasick automaton when pyahocorasick is installed, a regex alternation otherwise
+    """
+    needles = list(needles)
+    if not needles:
+        return lambda text: False
+    if "" in needles:
+        # An empty needle is contained in every text
+        return lambda text: True
+    if ahocorasick is not None:
+        automaton = ahocorasick.Automaton()
+        for needle in needles:
+            automaton.add_word(needle, needle)
+        automaton.make_automaton()
+        return lambda text: next(automaton.iter(text), None) is not None
+    search = re.compile('|'.join(re.escape(n) for n in sorted(needles, key=len, reverse=True))).search
+    return lambda text: search(text) is not None
+
+def build_should_respond(config):
+    """
+    Build should_respond for a config: the trigger settings are fixed while the bot runs, so they
+    are resolved here once and the returned check only runs the steps the config actually enables.
+    Keywords and ignored phrases are prepared in the configured case, the patterns compiled
+    """
+    respond_to_commands = config["response_settings"]["respond_to_direct_messages"]
+    trigger_detection = config["trigger_detection"]
+    case_sensitive = trigger_detection.get("case_sensitive", False)
+    keywords = config["keywords"]
+    ignored_phrases = trigger_detection.get("ignored_phrases", [])
+    if not case_sensitive:
+        keywords = [k.lower() for k in keywords]
+        ignored_phrases = [p.lower() for p in ignored_phrases]
+    whole_word_only = trigger_detection.get("whole_word_only", False)
+    must_be_at_beginning = trigger_detection.get("must_be_at_beginning", False)
+    
+    # Without detection (or keywords) only commands can trigger a response
+    if not trigger_detection.get("enabled", False) or not keywords:
+        if respond_to_commands:
+            return lambda text: text.startswith('/')
+        return lambda text: False
+    
+    contains_ignored_phrase = build_substring_matcher(ignored_phrases)
+    contains_keyword = build_substring_matcher(keywords)
+    # For keywords at the beginning of a message written without spaces
+    keyword_prefixes = tuple(keywords)
+    
+    if whole_word_only:
+        # All keywords in one alternation with word boundaries, so a message is scanned once.
+        # Longer keywords go first; the regex still backtracks into the others, so any keyword matches
+        alternation = '|'.join(re.escape(k) for k in sorted(keywords, key=len, reverse=True))
+        pattern_prefix = r'^\s*' if must_be_at_beginning else ''
+        search_keyword = re.compile(pattern_prefix + r'\b(?:' + alternation + r')\b').search
+        def matches(check_text):
+            return search_keyword(check_text) is not None
+    elif must_be_at_beginning:
+        # Only the first word decides, the no-spaces check below is not reached in this mode
+        def matches(check_text):
+            words = check_text.split(None, 1)
+            return bool(words) and contains_keyword(words[0])
+    else:
+        matches = contains_keyword
+    # must_be_at_beginning without whole words returns the first word check as the final answer
+    check_without_spaces = whole_word_only or not must_be_at_beginning
+    
+    def should_respond(text):
+        """Check if the message contains keywords that should trigger a response"""
+        # Always respond to direct messages if enabled
+        if respond_to_commands and text.startswith('/'):
+            return True
+        
+        # Ignored phrases are always checked against the lowercased text
+        text_lower = text.lower()
+        if contains_ignored_phrase(text_lower):
+            return False
+        
+        # Replace common punctuation with spaces to better isolate words (one C-level pass)
+        check_text = (text if case_sensitive else text_lower).translate(PUNCT_TABLE)
+        if matches(check_text):
+            return True
+        if not check_without_spaces:
+            return False
+        
+        # Also check for the keyword at the beginning without proper spacing
+        # This helps with cases like "Аняпривіт" or "Анякдела"
+        return check_text.replace(' ', '').startswith(keyword_prefixes)
+    
+    return should_respond